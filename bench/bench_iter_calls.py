@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+bench_iter_calls.py - Time parsing of the ESC call listing
+
+Compares esc.iter_calls, over the whole page and over 16 KB chunks as
+the HTTP driver streams it, with the BeautifulSoup parse it replaced.
+Give a saved viewcalls.wss page, or a listing of --rows calls is made
+up in the same layout.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from BeautifulSoup import BeautifulSoup
+
+from owen.driver import esc
+
+CHUNK = 16384
+
+
+def make_page(rows):
+    lines = ['<html><head><title>View calls</title></head><body>',
+             '<table class="ibm-data-table"><thead><tr>',
+             '<th>Call</th><th>Machine type</th><th>Serial number</th>',
+             '<th>IBM problem number</th><th>Opened</th><th>Status</th>',
+             '</tr></thead><tbody>']
+    for i in xrange(rows):
+        lines.append(
+            '<tr><td><a name="count" href="viewcalldetailtext.wss?'
+            'callid=%08d">%08d</a></td><td>7915</td><td>KQ%06d</td>'
+            '<td>P%07d</td><td>2013-06-%02d&nbsp;10:%02d</td>'
+            '<td>Waiting for parts</td></tr>' % (
+                i, i, i, i, i % 28 + 1, i % 60))
+    lines.append('</tbody></table><table><tr><td>footer</td></tr></table>')
+    lines.append('</body></html>')
+    return '\n'.join(lines)
+
+
+def soup_calls(html):
+    "The BeautifulSoup parse iter_calls replaced"
+    table = BeautifulSoup(html).find('table')
+    headers = None
+    rows = []
+    for row in table.findAll('tr'):
+        if headers is None:
+            headers = [h.text for h in row.findAll('th')]
+        else:
+            cells = [td.text for td in row.findAll('td')]
+            rows.append(dict(map(None, headers, cells)))
+    numbers = [row['IBM problem number'] for row in rows]
+    ids = [esc.call_id(a['href'])
+           for a in table.findAll('a', attrs={'name': 'count'})]
+    return zip(ids, numbers)
+
+
+def whole_calls(html):
+    return [(row.call_id, row.problem_number)
+            for row in esc.iter_calls(html)]
+
+
+def chunked_calls(html):
+    chunks = (html[i:i + CHUNK] for i in xrange(0, len(html), CHUNK))
+    return [(row.call_id, row.problem_number)
+            for row in esc.iter_calls(chunks)]
+
+
+def timed(func, html, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        result = func(html)
+        times.append(time.time() - start)
+    return result, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('page', nargs='?',
+                        help='Saved viewcalls.wss page to parse')
+    parser.add_argument('--rows', type=int, default=2000,
+                        help='Calls in the made-up listing')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of each parser, the best is reported')
+    args = parser.parse_args()
+    if args.page:
+        with open(args.page) as f:
+            html = f.read().decode('utf-8', 'replace')
+    else:
+        html = make_page(args.rows).decode('utf-8')
+    print "Page of %d KB" % (len(html.encode('utf-8')) / 1024)
+    expected = None
+    for name, func in [('BeautifulSoup', soup_calls),
+                       ('iter_calls', whole_calls),
+                       ('iter_calls, chunked', chunked_calls)]:
+        calls, best = timed(func, html, args.repeat)
+        if expected is None:
+            expected = calls
+        elif calls != expected:
+            sys.exit("%s found different calls" % name)
+        print "%-20s %4d calls %8.3fs" % (name, len(calls), best)
+
+
+if __name__ == '__main__':
+    main()
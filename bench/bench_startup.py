@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+bench_startup.py - Time how long ibm-ticket takes to start
+
+Runs fresh interpreters to time importing the CLI, printing --help and
+a first database command. A throwaway HOME holds the config and a new
+SQLite database, whose creation is timed on its own.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG = """[default]
+database = sqlite:///%s
+"""
+
+
+def run(argv, env):
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        subprocess.check_call(argv, env=env, stdout=devnull)
+        return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs of each command, the best is reported')
+    args = parser.parse_args()
+    home = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(home, '.owen.conf'), 'w') as f:
+            f.write(CONFIG % os.path.join(home, 'owen.db'))
+        env = dict(os.environ, HOME=home, PYTHONPATH=ROOT)
+        cli = [sys.executable, '-m', 'owen.cmd.ibm_ticket']
+        commands = [
+            ('python', [sys.executable, '-c', 'pass']),
+            ('import ibm_ticket', [sys.executable, '-c',
+                                   'import owen.cmd.ibm_ticket']),
+            ('--help', cli + ['--help']),
+            ('part-list', cli + ['part-list']),
+            ('ticket-list', cli + ['ticket-list']),
+        ]
+        print "%-20s %8.3fs" % ('create database',
+                                run(cli + ['part-list'], env))
+        for name, argv in commands:
+            best = min(run(argv, env) for i in range(args.repeat))
+            print "%-20s %8.3fs" % (name, best)
+    finally:
+        shutil.rmtree(home)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+""" owen.browser - lean Firefox and a pool of logged-in ESC sessions. """
+import contextlib
+import os
+import threading
+import time
+
+from selenium import webdriver
+
+from owen.driver import esc
+from owen.driver.forms import fill_form
+from owen.driver import sessions
+from owen import metrics
+
+SIGNIN_URL = esc.ESC_URL + esc.SIGNIN_PAGE
+
+# Profile settings that keep a scripted browser small: no disk cache,
+# a capped memory cache, no web fonts, and none of the background
+# update, telemetry and safe browsing traffic.
+LEAN_PREFS = {
+    'browser.cache.disk.enable': False,
+    'browser.cache.offline.enable': False,
+    'browser.cache.memory.capacity': 16384,
+    'browser.sessionhistory.max_total_viewers': 0,
+    'browser.sessionstore.resume_from_crash': False,
+    'browser.display.use_document_fonts': 0,
+    'network.prefetch-next': False,
+    'network.dns.disablePrefetch': True,
+    'app.update.enabled': False,
+    'extensions.update.enabled': False,
+    'browser.safebrowsing.enabled': False,
+    'browser.safebrowsing.malware.enabled': False,
+    'datareporting.healthreport.uploadEnabled': False,
+    'toolkit.telemetry.enabled': False,
+    'dom.ipc.processCount': 1,
+}
+
+
+class BrowserFactory(object):
+    """Starts Firefox with a lean profile for scripted ESC work.
+
+    Images, and optionally stylesheets, are never loaded. Pages count
+    as loaded once their DOM is ready with the default 'eager'
+    page_load_strategy, and give up after page_load_timeout seconds.
+    """
+    def __init__(self, headless=True, images=False, stylesheets=True,
+                 page_load_strategy='eager', page_load_timeout=60,
+                 script_timeout=30):
+        self.headless = headless
+        self.images = images
+        self.stylesheets = stylesheets
+        self.page_load_strategy = page_load_strategy
+        self.page_load_timeout = page_load_timeout
+        self.script_timeout = script_timeout
+
+    def _profile(self):
+        profile = webdriver.FirefoxProfile()
+        for name, value in LEAN_PREFS.iteritems():
+            profile.set_preference(name, value)
+        # 2 blocks the content type for every site
+        if not self.images:
+            profile.set_preference('permissions.default.image', 2)
+        if not self.stylesheets:
+            profile.set_preference('permissions.default.stylesheet', 2)
+        profile.update_preferences()
+        return profile
+
+    def __call__(self):
+        # Understood by Firefox itself, whichever Selenium starts it
+        if self.headless:
+            os.environ['MOZ_HEADLESS'] = '1'
+        else:
+            os.environ.pop('MOZ_HEADLESS', None)
+        capabilities = webdriver.DesiredCapabilities.FIREFOX.copy()
+        capabilities['pageLoadStrategy'] = self.page_load_strategy
+        driver = webdriver.Firefox(firefox_profile=self._profile(),
+                                   capabilities=capabilities)
+        driver.set_page_load_timeout(self.page_load_timeout)
+        driver.set_script_timeout(self.script_timeout)
+        return driver
+
+
+def from_config(config, section='browser'):
+    """BrowserFactory configured by a section of config, if it has one."""
+    def option(name, default, get):
+        if config.has_option(section, name):
+            return get(section, name)
+        return default
+    return BrowserFactory(
+        headless=option('headless', True, config.getboolean),
+        images=option('images', False, config.getboolean),
+        stylesheets=option('stylesheets', True, config.getboolean),
+        page_load_strategy=option('page-load-strategy', 'eager', config.get),
+        page_load_timeout=option('page-load-timeout', 60, config.getint),
+        script_timeout=option('script-timeout', 30, config.getint))
+
+
+def _credentials_key(credentials):
+    return (credentials.get('j_username'), credentials.get('j_password'))
+
+
+class BrowserSession(object):
+    """A long-lived browser logged in to ESC with one set of credentials."""
+    def __init__(self, credentials, store=None, browser=None):
+        self.credentials = dict(credentials)
+        self.key = _credentials_key(credentials)
+        self.store = store
+        with metrics.span('browser_launch'):
+            self.driver = (browser or BrowserFactory())()
+        self.uses = 0
+        self.last_used = time.time()
+        self.logged_in = False
+
+    def _sign_in(self):
+        with metrics.span('login'):
+            self.driver.get(SIGNIN_URL)
+            fill_form(self.driver, self.credentials)
+            self.driver.find_element_by_name('ibm-submit').click()
+        return self.driver.get_cookies()
+
+    def login(self):
+        sessions.login_browser(self.store, self.driver,
+                               self.credentials.get('j_username'),
+                               self._sign_in)
+        self.logged_in = True
+
+    def _resume(self):
+        """Start from saved cookies if there are any, else log in."""
+        saved = None
+        if self.store is not None:
+            saved = self.store.load(self.credentials.get('j_username'))
+        if saved:
+            sessions.use_browser_cookies(self.driver, saved)
+            self.logged_in = True
+        else:
+            self.login()
+
+    def get(self, url):
+        """Load url, logging in again if ESC sends us back to sign-in."""
+        if not self.logged_in:
+            self._resume()
+        self.driver.get(url)
+        if self.driver.current_url.startswith(SIGNIN_URL):
+            self.login()
+            self.driver.get(url)
+
+    def is_alive(self):
+        try:
+            self.driver.current_url
+        except Exception:
+            return False
+        return True
+
+    def reset(self):
+        """Close any popup windows left over from the last submission."""
+        handles = self.driver.window_handles
+        for window in handles[1:]:
+            self.driver.switch_to_window(window)
+            self.driver.close()
+        self.driver.switch_to_window(handles[0])
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except Exception:
+            pass
+
+
+class SessionPool(object):
+    """Bounded pool of BrowserSessions keyed by ESC credentials.
+
+    At most `size` browsers are alive at once. Idle sessions are quit
+    after `idle_timeout` seconds and every session is recycled after
+    `max_uses` submissions. With a sessions.SessionStore as `store`,
+    new browsers start from saved ESC cookies instead of logging in.
+    Browsers are started by `browser`, a BrowserFactory.
+    """
+    def __init__(self, size=2, idle_timeout=600, max_uses=25, store=None,
+                 browser=None):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.max_uses = max_uses
+        self.store = store
+        self.browser = browser
+        self._cond = threading.Condition()
+        self._idle = []
+        self._count = 0
+        reaper = threading.Thread(target=self._reap_forever)
+        reaper.daemon = True
+        reaper.start()
+
+    def _take_expired(self):
+        now = time.time()
+        expired = [s for s in self._idle
+                   if now - s.last_used > self.idle_timeout]
+        for session in expired:
+            self._idle.remove(session)
+            self._count -= 1
+        return expired
+
+    def _reap_forever(self):
+        while True:
+            time.sleep(max(self.idle_timeout / 2.0, 1))
+            with self._cond:
+                expired = self._take_expired()
+                self._cond.notify_all()
+            for session in expired:
+                session.quit()
+
+    def acquire(self, credentials):
+        key = _credentials_key(credentials)
+        while True:
+            with self._cond:
+                stale = self._take_expired()
+                while True:
+                    matches = [s for s in self._idle if s.key == key]
+                    session = matches[-1] if matches else None
+                    if session is not None:
+                        self._idle.remove(session)
+                        break
+                    elif self._count < self.size:
+                        self._count += 1
+                        break
+                    elif self._idle:
+                        # Evict the least recently used session of another
+                        # user; its slot is handed over to the new session.
+                        victim = min(self._idle, key=lambda s: s.last_used)
+                        self._idle.remove(victim)
+                        stale.append(victim)
+                        break
+                    else:
+                        self._cond.wait()
+            for old in stale:
+                old.quit()
+            if session is None:
+                break
+            if session.is_alive():
+                return session
+            self.release(session, failed=True)
+        try:
+            return BrowserSession(credentials, self.store, self.browser)
+        except Exception:
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, session, failed=False):
+        session.uses += 1
+        session.last_used = time.time()
+        if not failed:
+            try:
+                session.reset()
+            except Exception:
+                failed = True
+        if failed or session.uses >= self.max_uses:
+            session.quit()
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+        else:
+            with self._cond:
+                self._idle.append(session)
+                self._cond.notify()
+
+    @contextlib.contextmanager
+    def session(self, credentials):
+        with metrics.span('acquire_browser'):
+            session = self.acquire(credentials)
+        try:
+            yield session
+        except Exception:
+            self.release(session, failed=True)
+            raise
+        self.release(session)
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._count -= len(idle)
+        for session in idle:
+            session.quit()
@@ -1,5 +1,6 @@
 """ owen.cli - helpers for command line functions. """
 import argparse
+import shlex
 import sys
 
 def warn(error):
@@ -9,6 +10,19 @@ def die(error):
     warn(error)
     sys.exit(1)
 
+def prompt_lines(prompt):
+    """Yield lines typed at an interactive prompt until end of input."""
+    try:
+        import readline
+    except ImportError:
+        pass
+    while True:
+        try:
+            yield raw_input(prompt)
+        except EOFError:
+            print
+            return
+
 def _add_arg(f, *args, **kwargs):
     """Bind CLI arguments to a shell.py `do_foo` function."""
     if not hasattr(f, 'arguments'):
@@ -63,3 +77,38 @@ class Shell(object):
         parser = self.get_subcommand_parser()
         args = parser.parse_args(argv)
         args.func(self, args)
+
+    def run_command(self, parser, argv, where=None):
+        """Run one subcommand, returning False instead of exiting on error."""
+        try:
+            args = parser.parse_args(argv)
+            args.func(self, args)
+        except SystemExit as e:
+            # die() and argparse have already printed why
+            if not e.code:
+                return True
+            if where:
+                warn("%s: %s failed" % (where, argv[0]))
+            return False
+        except Exception as e:
+            warn("%s: %s" % (where or argv[0], e))
+            return False
+        return True
+
+    def run_script(self, lines, source='<stdin>'):
+        """Run a subcommand from each line, yielding (line number, ok).
+
+        Lines are split like a shell would; blank lines and comments
+        starting with # are skipped. All lines share one parser.
+        """
+        parser = self.get_subcommand_parser()
+        for lineno, line in enumerate(lines, 1):
+            where = '%s:%d' % (source, lineno)
+            try:
+                argv = shlex.split(line, comments=True)
+            except ValueError as e:
+                warn("%s: %s" % (where, e))
+                yield (lineno, False)
+                continue
+            if argv:
+                yield (lineno, self.run_command(parser, argv, where))
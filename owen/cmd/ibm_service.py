@@ -4,23 +4,15 @@ import ConfigParser
 import code
 import re
 import sys
-
-from selenium import webdriver
-from selenium.webdriver.common.keys import Keys
 import os
 
+from owen.driver.forms import fill_form
+
 HOME = os.environ['HOME']
 CONF_FILE = '%s/.owen' % HOME
 CONF = ConfigParser.RawConfigParser()
 CONF.read(CONF_FILE)
 
-def fill_form(driver, data):
-    for id,text in data.iteritems():
-        el = driver.find_element_by_id(id)
-        if not el:
-            raise Execption("Element not found with id: {}".format(id))
-        el.send_keys(text)
-
 def handle_after_hours_popup(driver, form_win):
     # Find the popup window
     maybe_popup_windows = [ w for w in driver.window_handles if w != form_win ]
@@ -38,6 +30,8 @@ def handle_after_hours_popup(driver, form_win):
             break
 
 def submit_ticket(args):
+    # Selenium is only loaded once we know a browser is needed
+    from owen import browser
     product_id = args.product
     model_id = args.model
     serial = args.serial
@@ -47,7 +41,7 @@ def submit_ticket(args):
         product_id = product_id[:len(product_id)-3]
 
     # Get driver, login and fill out form
-    driver = webdriver.Firefox()
+    driver = browser.from_config(CONF)()
     driver.get("https://www-930.ibm.com/support/esc/signin.jsp")
     fill_form(
         driver,
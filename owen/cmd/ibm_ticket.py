@@ -1,23 +1,95 @@
 #!/usr/bin/env python
+import collections
 import ConfigParser
+import csv
+import datetime
+import hashlib
 import json
 import os
-import prettytable
+import Queue
+import random
 import sys
-import sqlalchemy
-import sqlalchemy.sql
-from sqlalchemy.orm import sessionmaker
-import urllib2
+import threading
+import time
+import urlparse
 
 from owen import cli
-from owen.db import models as models
+
+# SQLAlchemy, prettytable, requests and the owen.db modules are imported
+# by the commands that use them, so that --help and light commands do
+# not pay for loading them.
+
+
+def _date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+def _json_value(value):
+    "JSON for the values json cannot encode itself: dates as ISO strings"
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+# Outcome of one submission request. `job` is the server's JSON reply.
+SubmitResult = collections.namedtuple('SubmitResult',
+    ['part_requests', 'ok', 'status_code', 'job', 'error'])
+
+# Server replies worth another attempt
+_RETRY_CODES = (429, 500, 502, 503, 504)
+
+
+def _ticket_selection(func):
+    """Add the arguments that pick tickets by id or by filter."""
+    for args, kwargs in [
+            (('--older-than',), {'type': int, 'metavar': 'DAYS',
+                                 'help': 'Only tickets created more than '
+                                         'DAYS days ago'}),
+            (('--status-match',), {'metavar': 'PATTERN',
+                                   'help': "Only tickets whose status matches "
+                                           "a SQL LIKE pattern, e.g. "
+                                           "'%%shipped%%'"}),
+            (('--all-for-host',), {'metavar': 'HOSTNAME',
+                                   'help': 'Only tickets for this machine'}),
+            (('tickets',), {'nargs': '*', 'type': int, 'metavar': 'ticket',
+                            'help': 'Ticket ID'})]:
+        func = cli.arg(*args, **kwargs)(func)
+    return func
+
+
+def _option(config, name, default, convert=str):
+    if config.has_option('default', name):
+        return convert(config.get('default', name))
+    return default
 
 
 class TicketSubmitter(object):
+    """Client for the submission server.
+
+    Requests share keep-alive connections and transient failures are
+    retried with jittered exponential backoff. Failures are returned
+    as SubmitResults rather than ending the process.
+    """
     def __init__(self, config):
         self.config = config
+        self.timeout = _option(config, 'submit_timeout', 30.0, float)
+        self.retries = _option(config, 'submit_retries', 3, int)
+        self.backoff = _option(config, 'submit_backoff', 1.0, float)
+        self.concurrency = _option(config, 'submit_concurrency', 4, int)
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            import requests
+            self._session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.concurrency)
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+        return self._session
 
-    def submit_ticket(self, part_request, comments=None):
+    def _ticket_body(self, part_request, comments=None):
         if part_request.part.fru is not None:
             part_description = 'FRU %s' % part_request.part.fru
         else:
@@ -35,15 +107,108 @@ class TicketSubmitter(object):
                          'Contact_Location', 'ContactName', 'ContPhoneNumber']
         for setting in conf_settings:
             body[setting] = self.config.get('default', setting)
+        return body
+
+    def _send(self, what, method, url, part_requests, **kwargs):
+        import requests
+        attempt = 0
+        while True:
+            status_code, error = None, None
+            try:
+                rsp = self.session.request(method, url, timeout=self.timeout,
+                                           **kwargs)
+                status_code = rsp.status_code
+                if status_code in (200, 202):
+                    job = rsp.json()
+                    if not isinstance(job, dict):
+                        raise ValueError("Reply is not a JSON object")
+                    return SubmitResult(part_requests, True, status_code,
+                                        job, None)
+                error = "Failed %s request! %d" % (what, status_code)
+                retry = status_code in _RETRY_CODES
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = "Failed %s request! %s" % (what, e)
+                retry = True
+            except (requests.RequestException, ValueError) as e:
+                # A bad URL or a reply that is not a job
+                error = "Failed %s request! %s" % (what, e)
+                retry = False
+            if not retry or attempt >= self.retries:
+                return SubmitResult(part_requests, False, status_code,
+                                    None, error)
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            attempt += 1
+
+    def _post(self, url, body, part_requests, key=None):
+        headers = {'Content-Type': 'application/json'}
+        if key is not None:
+            # Lets the server recognize retries of the same submission
+            headers['Idempotency-Key'] = key
+        return self._send('ticket submit', 'POST', url, part_requests,
+                          data=json.dumps(body), headers=headers)
+
+    def job_status(self, job_id, part_requests):
+        """Look up a job the server accepted for part_requests.
+
+        The SubmitResult's `job` holds the job's state and, once it is
+        done, its result.
+        """
+        url = urlparse.urljoin(self.config.get('default', 'submit_url'),
+                               'jobs/%s' % job_id)
+        return self._send('job status', 'GET', url, list(part_requests))
+
+    def submit_ticket(self, part_request, comments=None, key=None):
+        """Submit one ticket. A retry of the same submission must give
+        the same idempotency `key`, which no other submission may use;
+        without one the server derives a key from the ticket."""
+        body = self._ticket_body(part_request, comments=comments)
+        return self._post(self.config.get('default', 'submit_url'), body,
+                          [part_request], key)
+
+    def submit_each(self, part_requests, keys=None):
+        """Submit tickets one request apiece, `concurrency` at a time.
+
+        `keys` are the tickets' idempotency keys, if any. Returns a
+        SubmitResult per ticket, in the order given.
+        """
         url = self.config.get('default', 'submit_url')
-        req = urllib2.Request(url)
-        req.add_header('Content-Type: application/json')
-        req.add_data(json.dumps(body))
-        rsp = urllib2.urlopen(req)
-        code = rsp.getcode()
-        if code != 200:
-            print >> sys.stderr, "Failed ticket submit request! %d" % code
-            sys.exit(1)
+        keys = keys or [None] * len(part_requests)
+        # Bodies are built here since the ORM session is not thread-safe
+        todo = Queue.Queue()
+        for i, (pr, key) in enumerate(zip(part_requests, keys)):
+            todo.put((i, pr, key, self._ticket_body(pr)))
+        results = [None] * len(part_requests)
+
+        def work():
+            while True:
+                try:
+                    i, pr, key, body = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                results[i] = self._post(url, body, [pr], key)
+
+        workers = [threading.Thread(target=work) for i in
+                   range(min(self.concurrency, len(part_requests)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results
+
+    def submit_tickets(self, part_requests, keys=None):
+        """Submit several tickets in one request over a single ESC login.
+
+        The batch's idempotency key is made from the tickets' `keys`.
+        """
+        tickets = [self._ticket_body(pr) for pr in part_requests]
+        body = {'secret': self.config.get('default', 'secret'),
+                'tickets': tickets}
+        url = urlparse.urljoin(self.config.get('default', 'submit_url'),
+                               'batch')
+        key = None
+        if keys:
+            key = hashlib.sha1(','.join(keys)).hexdigest()
+        return self._post(url, body, list(part_requests), key)
 
 
 class TicketShell(cli.Shell):
@@ -51,58 +216,204 @@ class TicketShell(cli.Shell):
         config = ConfigParser.ConfigParser()
         config.read(configfile)
         self.config = config
-        database = config.get('default', 'database')
-        self.engine = sqlalchemy.create_engine(database)
-        models.Base.metadata.create_all(self.engine)
-        session_class = sessionmaker(bind=self.engine)
-        self.session = session_class()
+        self.database = config.get('default', 'database')
         self.submitter = TicketSubmitter(config)
+        self._engine = None
+        self._session = None
+        # Commands commit their own changes unless a batch is running
+        self.autocommit = True
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            import sqlalchemy
+            self._engine = sqlalchemy.create_engine(self.database)
+        return self._engine
+
+    @property
+    def session(self):
+        """Database session, connected and checked on first use."""
+        if self._session is None:
+            from sqlalchemy.orm import sessionmaker
+            self._check_schema()
+            self._session = sessionmaker(bind=self.engine)()
+        return self._session
+
+    def _check_schema(self):
+        from owen.db import migrate
+        version = migrate.current_version(self.engine)
+        if version == migrate.SCHEMA_VERSION:
+            return
+        if version is None and not migrate.has_tables(self.engine):
+            # Brand new database, create the schema
+            self._upgrade()
+        else:
+            cli.die("Database schema is out of date, "
+                    "run 'ibm-ticket db-upgrade'")
+
+    def _upgrade(self):
+        from owen.db import migrate
+        try:
+            migrate.upgrade(self.engine, self.database)
+        except migrate.MigrationError as e:
+            cli.die(str(e))
+
+    def do_db_upgrade(self, args):
+        """Upgrade the database schema to the latest version."""
+        self._not_in_batch('db-upgrade')
+        self._upgrade()
+
+    def _not_in_batch(self, command):
+        "Die if a batch is running, for commands that commit as they go"
+        if not self.autocommit:
+            cli.die("%s cannot be run from a batch" % command)
+
+    def _commit(self):
+        if self.autocommit:
+            self.session.commit()
+        else:
+            self.session.flush()
 
     def _add_obj(self, obj):
         self.session.add(obj)
-        self.session.commit()
+        self._commit()
 
-    def _table(self, query, columns, formatter=None, as_csv=None):
+    @cli.arg('file', nargs='?', default='-',
+             help='File of subcommands, one per line, - for stdin')
+    @cli.arg('--commit-every', type=int, default=0, metavar='N',
+             help='Commit after every N commands instead of once at the end')
+    def do_batch(self, args):
+        """Run many subcommands, one per line, in a single process.
+
+        The lines run in one transaction, committed at the end or with
+        --commit-every after every N commands. The first line that
+        fails stops the batch and rolls back every command since the
+        last commit. Commands that commit as they go (db-upgrade,
+        ticket-flush, ticket-submit-batch and ticket-sync) fail when
+        run from a batch.
+        """
+        self._not_in_batch('batch')
+        stream = sys.stdin if args.file == '-' else open(args.file)
+        source = '<stdin>' if args.file == '-' else args.file
+        self.autocommit = False
+        committed = 0
+        pending = []
+        failed = None
+        try:
+            for lineno, ok in self.run_script(stream, source):
+                if not ok:
+                    failed = lineno
+                    self.session.rollback()
+                    break
+                pending.append(lineno)
+                if args.commit_every and len(pending) >= args.commit_every:
+                    self.session.commit()
+                    committed += len(pending)
+                    pending = []
+            else:
+                self.session.commit()
+                committed += len(pending)
+        finally:
+            self.autocommit = True
+            if stream is not sys.stdin:
+                stream.close()
+        if failed is not None:
+            cli.die("%s: stopped at line %d, %d commands committed, "
+                    "%d rolled back" % (source, failed, committed,
+                                        len(pending)))
+
+    def do_shell(self, args):
+        """Read and run subcommands interactively."""
+        self._not_in_batch('shell')
+        for lineno, ok in self.run_script(cli.prompt_lines('ibm-ticket> '),
+                                          '<shell>'):
+            if not ok:
+                self.session.rollback()
+
+    def _table(self, query, columns, formatter=None, as_csv=None,
+               as_json=None, json_formatter=None):
+        """Print query's rows as a table, CSV or JSON.
+
+        formatter turns a row into the values shown, by default the
+        attributes named by columns. JSON rows come from json_formatter
+        if given, which should keep ids, counts and flags typed.
+        """
         if not formatter:
             formatter = lambda obj: map(
                 lambda col: getattr(obj, col), columns)
         if as_csv:
-            print ",".join(columns)
+            # Written row by row so large results are never buffered
+            writer = csv.writer(sys.stdout)
+            writer.writerow(columns)
+            for obj in query:
+                writer.writerow(formatter(obj))
+        elif as_json:
+            sep = '\n'
+            sys.stdout.write('[')
+            json_formatter = json_formatter or formatter
             for obj in query:
-                print ",".join(formatter(obj))
+                sys.stdout.write(sep + json.dumps(
+                    dict(zip(columns, json_formatter(obj))),
+                    default=_json_value))
+                sep = ',\n'
+            sys.stdout.write('\n]\n')
         else:
+            import prettytable
             tbl = prettytable.PrettyTable(columns)
             for obj in query:
                 tbl.add_row(formatter(obj))
-            print tbl.get_string(border=None)
+            print tbl.get_string(border=False)
 
     @cli.arg('--closed', action='store_true', help='Include closed tickets')
     @cli.arg('--csv', action='store_true', help='Print as CSV')
+    @cli.arg('--json', action='store_true', help='Print as JSON')
+    @cli.arg('--limit', type=int, help='Show at most LIMIT tickets')
+    @cli.arg('--offset', type=int, help='Skip the first OFFSET tickets')
+    @cli.arg('--since', type=_date,
+             help='Only tickets created on or after this YYYY-MM-DD date')
     def do_ticket_list(self, args):
-        q = self.session.query(models.PartRequest)
+        import sqlalchemy
+        from sqlalchemy.orm import joinedload
+        from owen.db import models
+        q = self.session.query(models.PartRequest).options(
+            joinedload(models.PartRequest.machine),
+            joinedload(models.PartRequest.part))
         if not args.closed:
-            q = q.filter(models.PartRequest.closed is not True)
+            q = q.filter(sqlalchemy.not_(models.PartRequest.closed))
+        if args.since:
+            q = q.filter(models.PartRequest.date_created >= args.since)
+        q = q.order_by(models.PartRequest.date_created,
+                       models.PartRequest.id)
+        if args.offset:
+            q = q.offset(args.offset)
+        if args.limit:
+            q = q.limit(args.limit)
         columns = ['status', 'id', 'hostname', 'model', 'serial', 'part',
                    'fru', 'count', 'ticket_number', 'created on',
                    'closed', 'closed on']
 
+        def row(obj):
+            return [obj.status, obj.id, obj.machine.hostname,
+                    obj.machine.machine_type, obj.machine.serial,
+                    obj.part.description, obj.part.fru, obj.part_count,
+                    obj.ticket_number, obj.date_created, obj.closed,
+                    obj.date_closed]
+
         def row_format(obj):
             empty_none = lambda x: x if x is not None else ''
-            row = [obj.status, obj.id, obj.machine.hostname,
-                   obj.machine.machine_type, obj.machine.serial,
-                   obj.part.description, obj.part.fru, obj.part_count,
-                   obj.ticket_number, obj.date_created, obj.closed,
-                   obj.date_closed]
-            return map(str, map(empty_none, row))
-        q.order_by(models.PartRequest.date_created)
-        self._table(q.all(), columns, formatter=row_format, as_csv=args.csv)
+            return map(str, map(empty_none, row(obj)))
+        self._table(q.yield_per(500), columns, formatter=row_format,
+                    as_csv=args.csv, as_json=args.json, json_formatter=row)
 
     @cli.arg('--hostname', required=True, help="Machine hostname")
     @cli.arg('--part', required=True, help="ID of malfunctioning part")
     @cli.arg('--status', help="Optional current status message")
     @cli.arg('--count', help="Number of items requested", default=1)
-    @cli.arg('--submit', action='store_true', help='Submit ticket to IBM')
+    @cli.arg('--submit', action='store_true',
+             help='Queue the ticket for submission to IBM')
     def do_ticket_create(self, args):
+        from owen import outbox
+        from owen.db import models
         machine = self.session.query(models.Machine).\
             filter(models.Machine.hostname == args.hostname).first()
         part = self.session.query(models.Part).\
@@ -111,104 +422,417 @@ class TicketShell(cli.Shell):
             cli.die("Unknown machine hostname %s" % args.hostname)
         elif not part:
             cli.die("Unknown part id %s" % args.part)
+        elif args.submit and outbox.unsendable(machine):
+            cli.die("Cannot submit: %s" % outbox.unsendable(machine))
         pr = models.PartRequest(status=args.status, machine=machine,
                                 part=part, part_count=args.count)
         if args.submit:
-            self.submitter.submit_ticket(pr)
+            outbox.enqueue(self.session, [pr])
         self._add_obj(pr)
 
-    @cli.arg('ticket', help='Ticket ID')
-    @cli.arg('--delete', action='store_true', help="Delete the ticket")
+    @cli.arg('file', nargs='?', default='-',
+             help='CSV or JSON file of failures with hostname and part '
+                  '(part id), - for stdin')
+    @cli.arg('--format', choices=['csv', 'json'],
+             help='Input format, by default guessed from the file name')
+    @cli.arg('--submit', action='store_true',
+             help='Queue the new tickets for submission to IBM')
+    def do_ticket_create_bulk(self, args):
+        """Create tickets for a list of failures, skipping open ones."""
+        from owen import outbox
+        from owen.db import bulk
+        records = bulk.read_records(args.file, args.format)
+        created, skipped, unknown = bulk.create_part_requests(self.session,
+                                                              records)
+        rejected = []
+        if args.submit:
+            rejected = outbox.enqueue(self.session, created)
+        self._commit()
+        for pr in rejected:
+            cli.warn("Ticket %d not queued: %s" % (
+                pr.id, outbox.unsendable(pr.machine)))
+        print "Created %d, skipped %d already open, %d unknown" % (
+            len(created), skipped, unknown)
+
+    @cli.arg('--batch-size', type=int, default=50,
+             help='Number of tickets sent per batch')
+    @cli.arg('--each', action='store_true',
+             help='Send one request per ticket, several at a time')
+    @cli.arg('--interval', type=int,
+             help='Keep running, flushing every INTERVAL seconds')
+    @cli.arg('--max-attempts', type=int, default=5, metavar='N',
+             help='Hold tickets after N failed attempts to send them')
+    def do_ticket_flush(self, args):
+        """Send tickets queued with --submit to the submission server.
+
+        Tickets sent earlier are checked first: those whose call ESC
+        accepted get its problem number as their ticket number, and
+        those whose call failed before reaching ESC are sent again.
+        Those that may have reached it, or that failed --max-attempts
+        times, are held and reported: look for the call in ESC, then
+        record its number with ticket-alter --number or send the
+        ticket again with ticket-requeue.
+        """
+        from owen import outbox
+        self._not_in_batch('ticket-flush')
+        kwargs = {'batch_size': args.batch_size, 'each': args.each,
+                  'max_attempts': args.max_attempts}
+        if args.interval:
+            runs = outbox.flush_forever(self.session, self.submitter,
+                                        args.interval, **kwargs)
+        else:
+            runs = [outbox.flush(self.session, self.submitter, **kwargs)]
+        for sent, delivered, failed, held in runs:
+            for entry in held:
+                cli.warn("Ticket %d held: %s" % (
+                    entry.part_request_id, entry.last_error))
+            print "Sent %d, delivered %d, %d failed, %d held" % (
+                sent, delivered, failed, len(held))
+            sys.stdout.flush()
+
+    @cli.arg('tickets', nargs='+', type=int, metavar='ticket',
+             help='Ticket ID')
+    def do_ticket_requeue(self, args):
+        """Send tickets held by ticket-flush again.
+
+        Only do this once ESC shows no call for them.
+        """
+        from owen import outbox
+        from owen.db import models
+        self._check_ids(models.PartRequest, args.tickets, 'ticket')
+        count = outbox.requeue(self.session, args.tickets)
+        self._commit()
+        print "Requeued %d submissions" % count
+
+    def _print_results(self, results):
+        failed = 0
+        for result in results:
+            ids = ','.join(str(pr.id) for pr in result.part_requests)
+            if result.ok:
+                print "Submitted ticket %s as job %s" % (ids,
+                                                         result.job['id'])
+            else:
+                failed += 1
+                cli.warn("Ticket %s: %s" % (ids, result.error))
+        if failed:
+            cli.die("%d of %d submissions failed" % (failed, len(results)))
+
+    @cli.arg('--batch-size', type=int, default=50,
+             help='Number of tickets sent per batch')
+    @cli.arg('--each', action='store_true',
+             help='Send one request per ticket, several at a time')
+    def do_ticket_submit_batch(self, args):
+        """Submit every open ticket that was never submitted, in batches.
+
+        Accepted submissions are recorded in the outbox after every
+        batch, and ticket-flush picks up their problem numbers.
+        """
+        import sqlalchemy
+        from owen.db import models
+        # What the server accepted must be recorded whatever follows
+        self._not_in_batch('ticket-submit-batch')
+        PR, Outbox = models.PartRequest, models.OutboxEntry
+        submitted = self.session.query(Outbox.part_request_id)
+        q = self.session.query(PR).\
+            filter(sqlalchemy.not_(PR.closed)).\
+            filter(PR.ticket_number == None).\
+            filter(sqlalchemy.not_(PR.id.in_(submitted.subquery()))).\
+            order_by(PR.id)
+        part_requests = q.all()
+        if not part_requests:
+            cli.die("No unsubmitted tickets")
+        keys = dict((pr.id, models.new_key()) for pr in part_requests)
+        results = []
+        for start in range(0, len(part_requests), args.batch_size):
+            batch = part_requests[start:start + args.batch_size]
+            ordered = [keys[pr.id] for pr in batch]
+            if args.each:
+                batch_results = self.submitter.submit_each(batch, ordered)
+            else:
+                batch_results = [self.submitter.submit_tickets(batch,
+                                                               ordered)]
+            now = datetime.datetime.now()
+            for result in batch_results:
+                if result.ok:
+                    self.session.add_all([
+                        Outbox(part_request=pr, job_id=result.job.get('id'),
+                               idempotency_key=keys[pr.id], attempts=1,
+                               date_attempted=now)
+                        for pr in result.part_requests])
+            self._commit()
+            results.extend(batch_results)
+        self._print_results(results)
+
+    @cli.arg('--interval', type=int,
+             help='Keep running, syncing every INTERVAL seconds')
+    @cli.arg('--concurrency', type=int, default=2,
+             help='Number of ticket detail pages to fetch at once')
+    def do_ticket_sync(self, args):
+        """Update ticket status from IBM ESC."""
+        from owen import driver
+        from owen import sync
+        self._not_in_batch('ticket-sync')
+        status_sync = sync.StatusSync(self.session,
+                                      driver.load_driver(self.config),
+                                      concurrency=args.concurrency)
+        if args.interval:
+            cycles = status_sync.run_forever(args.interval)
+        else:
+            cycles = [status_sync.run_once()]
+        for checked, updated, failed in cycles:
+            print "Checked %d tickets, updated %d, %d failed" % (
+                checked, updated, failed)
+            sys.stdout.flush()
+
+    def _check_ids(self, model, ids, noun):
+        "Die unless every id in ids names a row of model"
+        found = set(id for (id,) in
+                    self.session.query(model.id).filter(model.id.in_(ids)))
+        unknown = sorted(set(ids) - found)
+        if unknown:
+            cli.die("Unknown %s id: %s" % (noun, ', '.join(map(str, unknown))))
+
+    def _bulk_update(self, q, values):
+        count = q.update(values, synchronize_session=False)
+        # Objects loaded earlier in a batch would otherwise be stale
+        self.session.expire_all()
+        return count
+
+    def _ticket_query(self, args):
+        """Tickets picked by id and the --all-for-host, --status-match
+        and --older-than filters, all of which must match."""
+        from owen.db import models
+        PR = models.PartRequest
+        if not (args.tickets or args.all_for_host or args.status_match or
+                args.older_than is not None):
+            cli.die("Give ticket ids or at least one filter")
+        q = self.session.query(PR)
+        if args.tickets:
+            self._check_ids(PR, args.tickets, 'ticket')
+            q = q.filter(PR.id.in_(args.tickets))
+        if args.all_for_host:
+            machines = self.session.query(models.Machine.id).\
+                filter(models.Machine.hostname == args.all_for_host)
+            q = q.filter(PR.machine_id.in_(machines.subquery()))
+        if args.status_match:
+            q = q.filter(PR.status.like(args.status_match))
+        if args.older_than is not None:
+            cutoff = datetime.datetime.now() - \
+                datetime.timedelta(days=args.older_than)
+            q = q.filter(PR.date_created < cutoff)
+        return q
+
+    @_ticket_selection
+    @cli.arg('--delete', action='store_true', help="Delete the tickets")
     @cli.arg('--status', help="Free-form status message")
     @cli.arg('--number', '-n', help='External ticket-tracking number')
     def do_ticket_alter(self, args):
-        q = self.session.query(models.PartRequest).\
-            filter(models.PartRequest.id == args.ticket)
-        if q.count() != 1:
-            cli.die("Unknown ticket: %s" % args.ticket)
-        pr = q.first()
-        if not pr:
-            cli.die("Unknown ticket with id %s" % (args.ticket))
-        if args.status:
-            pr.status = args.status
-        if args.number:
-            pr.ticket_number = args.number
+        """Change or delete tickets picked by id or filter.
+
+        Setting --number also settles a submission of the ticket held
+        by ticket-flush.
+        """
+        import sqlalchemy
+        from owen import outbox
+        from owen.db import models
+        q = self._ticket_query(args)
+        if args.number and (len(args.tickets) != 1 or args.all_for_host or
+                            args.status_match or args.older_than is not None):
+            cli.die("--number can only be set on a single ticket id")
         if args.delete:
-            q.delete()
-        self.session.commit()
+            Outbox = models.OutboxEntry
+            ids = q.with_entities(models.PartRequest.id).subquery()
+            pending = self.session.query(sqlalchemy.func.count(Outbox.id)).\
+                filter(Outbox.part_request_id.in_(ids)).\
+                filter(sqlalchemy.not_(Outbox.delivered)).\
+                filter(sqlalchemy.not_(Outbox.held)).scalar()
+            if pending:
+                cli.die("Delete failed: %d submissions still queued, "
+                        "run 'ibm-ticket ticket-flush' first" % pending)
+            self.session.query(Outbox).\
+                filter(Outbox.part_request_id.in_(ids)).\
+                delete(synchronize_session=False)
+            count = q.delete(synchronize_session=False)
+            self.session.expire_all()
+            print "Deleted %d tickets" % count
+        else:
+            values = {}
+            if args.status:
+                values['status'] = args.status
+            if args.number:
+                values['ticket_number'] = args.number
+                outbox.settle(self.session, args.tickets)
+            if not values:
+                cli.die("Nothing to change")
+            print "Updated %d tickets" % self._bulk_update(q, values)
+        self._commit()
 
-    @cli.arg('ticket', help='Ticket ID')
+    @_ticket_selection
     def do_ticket_close(self, args):
-        pr = self.session.query(models.PartRequest).filter(
-            models.PartRequest.id == args.ticket).first()
-        if not pr:
-            cli.die("Unknown ticket with id %s" % (args.ticket))
-        pr.close()
-        self.session.commit()
+        """Close the open tickets picked by id or filter."""
+        import sqlalchemy
+        from owen.db import models
+        q = self._ticket_query(args).\
+            filter(sqlalchemy.not_(models.PartRequest.closed))
+        count = self._bulk_update(q, {'closed': True,
+                                      'date_closed': datetime.datetime.now()})
+        self._commit()
+        print "Closed %d tickets" % count
 
+    @cli.arg('--csv', action='store_true', help='Print as CSV')
+    @cli.arg('--json', action='store_true', help='Print as JSON')
     def do_part_list(self, args):
+        from owen.db import models
         q = self.session.query(models.Part).order_by(models.Part.id)
-        self._table(q, ['id', 'fru', 'description'])
+        self._table(q, ['id', 'fru', 'description'], as_csv=args.csv,
+                    as_json=args.json)
 
     @cli.arg('--desc', required=True, help='description of the part')
     @cli.arg('--fru', help='FRU number')
     def do_part_create(self, args):
+        from owen.db import models
         self._add_obj(models.Part(description=args.desc, fru=args.fru))
 
-    @cli.arg('part', help='part id')
+    @cli.arg('file', nargs='?', default='-',
+             help='CSV or JSON file with fru and description, - for stdin')
+    @cli.arg('--format', choices=['csv', 'json'],
+             help='Input format, by default guessed from the file name')
+    def do_part_import(self, args):
+        """Create or update parts, matched by FRU, from a file."""
+        from owen.db import bulk
+        records = bulk.read_records(args.file, args.format)
+        counts = bulk.upsert_parts(self.session, records)
+        self._commit()
+        print "Inserted %d, updated %d, skipped %d" % counts
+
+    @cli.arg('parts', nargs='+', type=int, metavar='part', help='part id')
     @cli.arg('--desc', help='description of the part')
     @cli.arg('--fru', help='FRU number')
-    @cli.arg('--delete', action='store_true', help='Delete this entry')
+    @cli.arg('--delete', action='store_true', help='Delete these entries')
     def do_part_alter(self, args):
-        q = self.session.query(models.Part).filter(models.Part.id == args.part)
-        part = q.first()
-        if not part:
-            cli.die("Unknown part with id %s" % (args.part))
-        if args.desc:
-            part.description = args.desc
-        if args.fru:
-            part.fru = args.fru
+        """Change or delete parts, refusing to delete any with tickets."""
+        import sqlalchemy
+        from owen.db import models
+        PR = models.PartRequest
+        self._check_ids(models.Part, args.parts, 'part')
+        q = self.session.query(models.Part).\
+            filter(models.Part.id.in_(args.parts))
         if args.delete:
-            pr_count = self.session.query(models.PartRequest).\
-                filter(models.PartRequest.part_id == args.part).count()
-            if pr_count != 0:
-                cli.die("Delete failed: Part %s associated with %d tickets!" %
-                        (args.part, pr_count))
-            q.delete()
-        self.session.commit()
+            in_use = self.session.query(PR.part_id,
+                                        sqlalchemy.func.count(PR.id)).\
+                filter(PR.part_id.in_(args.parts)).\
+                group_by(PR.part_id).order_by(PR.part_id).all()
+            if in_use:
+                cli.die("Delete failed: " + ', '.join(
+                    "Part %s associated with %d tickets!" % row
+                    for row in in_use))
+            q.delete(synchronize_session=False)
+            self.session.expire_all()
+        else:
+            values = {}
+            if args.desc:
+                values['description'] = args.desc
+            if args.fru:
+                values['fru'] = args.fru
+            if values:
+                self._bulk_update(q, values)
+        self._commit()
 
+    @cli.arg('--csv', action='store_true', help='Print as CSV')
+    @cli.arg('--json', action='store_true', help='Print as JSON')
     def do_host_list(self, args):
+        from owen.db import models
         q = self.session.query(models.Machine).order_by(models.Machine.id)
-        self._table(q, ['id', 'hostname', 'machine_type', 'serial'])
+        self._table(q, ['id', 'hostname', 'machine_type', 'serial'],
+                    as_csv=args.csv, as_json=args.json)
 
     @cli.arg('hostname', help='Hostname of the machine')
     @cli.arg('machine_type', help='Machine model number')
     @cli.arg('serial', help='Serial number of the machine')
     def do_host_create(self, args):
+        from owen.db import models
         self._add_obj(models.Machine(hostname=args.hostname,
                       machine_type=args.machine_type, serial=args.serial))
 
-    @cli.arg('hostname', help='Hostname of the machine')
+    @cli.arg('file', nargs='?', default='-',
+             help='CSV or JSON file with hostname, machine_type and serial, '
+                  '- for stdin')
+    @cli.arg('--format', choices=['csv', 'json'],
+             help='Input format, by default guessed from the file name')
+    def do_host_import(self, args):
+        """Create or update machines, matched by hostname.
+
+        Machines whose serial already belongs to another hostname are
+        skipped and reported.
+        """
+        from owen.db import bulk
+        records = bulk.read_records(args.file, args.format)
+        inserted, updated, skipped, conflicts = \
+            bulk.upsert_machines(self.session, records)
+        self._commit()
+        for hostname, serial, owner in conflicts:
+            cli.warn("Skipped %s: serial %s belongs to %s" % (
+                hostname, serial, owner))
+        print "Inserted %d, updated %d, skipped %d" % (inserted, updated,
+                                                       skipped)
+
+    @cli.arg('--prune', action='store_true',
+             help='Delete machines Nova does not know, unless they have '
+                  'tickets')
+    @cli.arg('--rename', action='store_true',
+             help="Rename machines to Nova's hostname when only the "
+                  "domain or case differs")
+    def do_host_sync(self, args):
+        """Update machines from the hypervisor list of OpenStack Nova."""
+        from owen import nova
+        from owen.db import bulk
+        hostnames = list(nova.hypervisor_hostnames(nova.client(self.config)))
+        counts = bulk.sync_machines(self.session, hostnames,
+                                    prune=args.prune, rename=args.rename)
+        self._commit()
+        print "Inserted %d, updated %d, deleted %d" % counts
+
+    @cli.arg('hostnames', nargs='+', metavar='hostname',
+             help='Hostname of the machine')
     @cli.arg('--type', '-t', help='Machine model number')
     @cli.arg('--serial', '-s', help='Serial number of the machine')
-    @cli.arg('--delete', '-d', action='store_true', help='Delete this entry')
+    @cli.arg('--delete', '-d', action='store_true',
+             help='Delete these entries')
     def do_host_alter(self, args):
-        q = self.session.query(models.Machine).\
-            filter(models.Machine.hostname == args.hostname)
-        m = q.first()
-        if args.type:
-            m.machine_type = args.type
-        if args.serial:
-            m.serial = args.serial
+        """Change or delete machines, refusing to delete any with tickets."""
+        import sqlalchemy
+        from owen.db import models
+        Machine, PR = models.Machine, models.PartRequest
+        found = set(h for (h,) in self.session.query(Machine.hostname).
+                    filter(Machine.hostname.in_(args.hostnames)))
+        unknown = sorted(set(args.hostnames) - found)
+        if unknown:
+            cli.die("Unknown machine hostname: %s" % ', '.join(unknown))
+        q = self.session.query(Machine).\
+            filter(Machine.hostname.in_(args.hostnames))
         if args.delete:
-            count = self.session.query(models.PartRequest).\
-                filter(models.PartRequest.machine_id == args.id).count()
-            if count > 0:
-                cli.die("Delete failed: Machine %s associated with %d tickets!"
-                        % (args.id, count))
-            q.delete()
-            self.session.commit()
-
+            in_use = self.session.query(Machine.hostname,
+                                        sqlalchemy.func.count(PR.id)).\
+                join(PR, PR.machine_id == Machine.id).\
+                filter(Machine.hostname.in_(args.hostnames)).\
+                group_by(Machine.hostname).order_by(Machine.hostname).all()
+            if in_use:
+                cli.die("Delete failed: " + ', '.join(
+                    "Machine %s associated with %d tickets!" % row
+                    for row in in_use))
+            q.delete(synchronize_session=False)
+            self.session.expire_all()
+        else:
+            if args.serial and len(args.hostnames) != 1:
+                cli.die("--serial can only be set on a single machine")
+            values = {}
+            if args.type:
+                values['machine_type'] = args.type
+            if args.serial:
+                values['serial'] = args.serial
+            if values:
+                self._bulk_update(q, values)
+        self._commit()
 
 def main():
     DEFAULT_CONF_PATH = os.path.join(os.environ.get('HOME'), '.owen.conf')
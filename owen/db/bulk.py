@@ -0,0 +1,261 @@
+""" owen.db.bulk - batched inserts and updates for inventory imports. """
+import csv
+import json
+import sys
+
+import sqlalchemy
+from sqlalchemy.sql import select
+
+from owen.db import models
+
+BATCH_SIZE = 500
+
+
+def read_records(path, format=None):
+    """Read a list of dicts from a CSV or JSON file, or stdin for '-'."""
+    if format is None:
+        format = 'json' if path.endswith('.json') else 'csv'
+    stream = sys.stdin if path == '-' else open(path)
+    try:
+        if format == 'json':
+            records = json.load(stream)
+        else:
+            records = list(csv.DictReader(stream))
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    cleaned = []
+    for record in records:
+        clean = {}
+        for key, value in record.iteritems():
+            if isinstance(value, basestring):
+                value = value.strip() or None
+            clean[key.strip()] = value
+        cleaned.append(clean)
+    return cleaned
+
+
+def _chunks(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _last_by(records, key):
+    "Drop records without `key` and all but the last record for each key"
+    latest = {}
+    order = []
+    for record in records:
+        value = record.get(key)
+        if value is None:
+            continue
+        if value not in latest:
+            order.append(value)
+        latest[value] = record
+    return [latest[value] for value in order]
+
+
+def _changes(row, record, columns):
+    "Columns where record has a value that differs from the stored row"
+    return [c for c in columns
+            if record.get(c) is not None and record[c] != row[c]]
+
+
+def _apply(session, table, inserts, updates, columns):
+    if inserts:
+        session.execute(table.insert(), inserts)
+    if updates:
+        stmt = table.update().\
+            where(table.c.id == sqlalchemy.bindparam('_id')).\
+            values(**dict((c, sqlalchemy.bindparam('_' + c))
+                          for c in columns))
+        session.execute(stmt, updates)
+
+
+def upsert_machines(session, records, batch_size=BATCH_SIZE):
+    """Insert or update machines matched by hostname.
+
+    A record whose serial already belongs to another machine, stored
+    or earlier in the records, is skipped rather than renaming that
+    machine or failing the unique index. Runs inside the session's
+    transaction; the caller commits. Returns (inserted, updated,
+    skipped, conflicts), where conflicts lists the (hostname, serial,
+    owner hostname) of those records and is included in skipped.
+    """
+    table = models.Machine.__table__
+    columns = ['hostname', 'machine_type', 'serial']
+    unique = _last_by(records, 'hostname')
+    skipped = len(records) - len(unique)
+    inserted = updated = 0
+    conflicts = []
+    # Serials given to a hostname by an earlier record
+    claimed = {}
+    for batch in _chunks(unique, batch_size):
+        hostnames = [r['hostname'] for r in batch]
+        serials = [r['serial'] for r in batch if r.get('serial')]
+        match = table.c.hostname.in_(hostnames)
+        if serials:
+            match = sqlalchemy.or_(match, table.c.serial.in_(serials))
+        existing = session.execute(select([table]).where(match)).fetchall()
+        by_host = dict((row.hostname, row) for row in existing)
+        by_serial = dict((row.serial, row) for row in existing)
+        inserts, updates = [], []
+        for record in batch:
+            hostname, serial = record['hostname'], record.get('serial')
+            row = by_host.get(hostname)
+            other = by_serial.get(serial) if serial else None
+            if other is not None and (row is None or other.id != row.id):
+                owner = other.hostname
+            else:
+                owner = claimed.get(serial, hostname)
+            if owner != hostname:
+                conflicts.append((hostname, serial, owner))
+                skipped += 1
+                continue
+            if serial:
+                claimed[serial] = hostname
+            if row is None:
+                inserts.append(dict((c, record.get(c)) for c in columns))
+            elif _changes(row, record, columns):
+                update = {'_id': row.id}
+                for c in columns:
+                    update['_' + c] = record.get(c) or row[c]
+                updates.append(update)
+            else:
+                skipped += 1
+        _apply(session, table, inserts, updates, columns)
+        inserted += len(inserts)
+        updated += len(updates)
+    return (inserted, updated, skipped, conflicts)
+
+
+def upsert_parts(session, records, batch_size=BATCH_SIZE):
+    """Insert or update parts matched by FRU number.
+
+    Records without a FRU are skipped. Runs inside the session's
+    transaction; the caller commits. Returns (inserted, updated, skipped).
+    """
+    table = models.Part.__table__
+    columns = ['fru', 'description']
+    unique = _last_by(records, 'fru')
+    skipped = len(records) - len(unique)
+    inserted = updated = 0
+    for batch in _chunks(unique, batch_size):
+        frus = [r['fru'] for r in batch]
+        existing = session.execute(
+            select([table]).where(table.c.fru.in_(frus))).fetchall()
+        by_fru = dict((row.fru, row) for row in existing)
+        inserts, updates = [], []
+        for record in batch:
+            row = by_fru.get(record['fru'])
+            if row is None:
+                inserts.append(dict((c, record.get(c)) for c in columns))
+            elif _changes(row, record, columns):
+                update = {'_id': row.id}
+                for c in columns:
+                    update['_' + c] = record.get(c) or row[c]
+                updates.append(update)
+            else:
+                skipped += 1
+        _apply(session, table, inserts, updates, columns)
+        inserted += len(inserts)
+        updated += len(updates)
+    return (inserted, updated, skipped)
+
+
+def _short_name(hostname):
+    return hostname.split('.')[0].lower()
+
+
+def sync_machines(session, hostnames, prune=False, rename=False):
+    """Make the machines table match a list of hostnames.
+
+    Hostnames are compared by their lower-cased first label, so a
+    machine stored as 'node1' is not duplicated when the list has
+    'node1.example.com'; with `rename` it is renamed to the listed
+    name. With `prune`, machines missing from the list are deleted
+    unless they have part requests. Runs inside the session's
+    transaction; the caller commits. Returns (inserted, updated,
+    deleted).
+    """
+    table = models.Machine.__table__
+    wanted = dict((_short_name(h), h) for h in hostnames)
+    have = {}
+    for row in session.execute(select([table.c.id, table.c.hostname])):
+        if row.hostname:
+            have.setdefault(_short_name(row.hostname), row)
+    inserts = [{'hostname': hostname, 'machine_type': None, 'serial': None}
+               for key, hostname in wanted.iteritems() if key not in have]
+    updates = []
+    if rename:
+        updates = [{'_id': row.id, '_hostname': wanted[key]}
+                   for key, row in have.iteritems()
+                   if key in wanted and row.hostname != wanted[key]]
+    deletes = set()
+    if prune:
+        deletes = set(row.id for key, row in have.iteritems()
+                      if key not in wanted)
+    requests = models.PartRequest.__table__
+    for batch in _chunks(list(deletes), BATCH_SIZE):
+        in_use = session.execute(
+            select([requests.c.machine_id]).distinct().
+            where(requests.c.machine_id.in_(batch)))
+        deletes -= set(row.machine_id for row in in_use)
+    _apply(session, table, inserts, updates, ['hostname'])
+    for batch in _chunks(list(deletes), BATCH_SIZE):
+        session.execute(table.delete().where(table.c.id.in_(batch)))
+    return (len(inserts), len(updates), len(deletes))
+
+
+def create_part_requests(session, records):
+    """Create a PartRequest for each (hostname, part) record.
+
+    Records name a machine by `hostname` and a part by its `part` id,
+    optionally with `count` and `status`. Hostnames and parts are each
+    resolved with a single IN query. Records for a machine and part
+    that already have an open request, or that repeat an earlier
+    record, are skipped. Runs inside the session's transaction; the
+    caller commits. Returns (created requests, skipped, unknown).
+    """
+    hostnames = set(r.get('hostname') for r in records) - set([None])
+    part_ids = set()
+    for record in records:
+        try:
+            part_ids.add(int(record.get('part')))
+        except (TypeError, ValueError):
+            pass
+    machines, parts = {}, {}
+    for batch in _chunks(list(hostnames), BATCH_SIZE):
+        for machine in session.query(models.Machine).\
+                filter(models.Machine.hostname.in_(batch)):
+            machines[machine.hostname] = machine
+    for batch in _chunks(list(part_ids), BATCH_SIZE):
+        for part in session.query(models.Part).\
+                filter(models.Part.id.in_(batch)):
+            parts[part.id] = part
+    PR = models.PartRequest
+    open_pairs = set()
+    machine_ids = [m.id for m in machines.itervalues()]
+    for batch in _chunks(machine_ids, BATCH_SIZE):
+        open_pairs.update(session.query(PR.machine_id, PR.part_id).
+                          filter(sqlalchemy.not_(PR.closed)).
+                          filter(PR.machine_id.in_(batch)))
+    created = []
+    skipped = unknown = 0
+    for record in records:
+        machine = machines.get(record.get('hostname'))
+        try:
+            part = parts.get(int(record.get('part')))
+        except (TypeError, ValueError):
+            part = None
+        if machine is None or part is None:
+            unknown += 1
+            continue
+        if (machine.id, part.id) in open_pairs:
+            skipped += 1
+            continue
+        open_pairs.add((machine.id, part.id))
+        created.append(PR(machine=machine, part=part,
+                          status=record.get('status'),
+                          part_count=record.get('count') or 1))
+    session.add_all(created)
+    return (created, skipped, unknown)
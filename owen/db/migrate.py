@@ -0,0 +1,48 @@
+""" owen.db.migrate - Alembic schema versioning for the ticket database. """
+import os
+
+import sqlalchemy
+import sqlalchemy.exc
+
+MIGRATIONS = os.path.join(os.path.dirname(__file__), 'migrations')
+
+# Newest revision in migrations/versions. Update this with every new
+# migration so that the startup check does not need to load Alembic.
+SCHEMA_VERSION = '1e8c5a2f7d63'
+# Revision matching databases made by create_all before migrations
+BASELINE_VERSION = 'd2e7781a5b06'
+
+
+class MigrationError(Exception):
+    """A migration cannot run until the data is fixed by hand."""
+
+
+def alembic_config(database):
+    from alembic.config import Config
+    config = Config()
+    config.set_main_option('script_location', MIGRATIONS)
+    config.set_main_option('sqlalchemy.url', database)
+    return config
+
+
+def current_version(engine):
+    "Schema revision recorded in the database, or None if unversioned"
+    try:
+        return engine.execute(
+            "SELECT version_num FROM alembic_version").scalar()
+    except sqlalchemy.exc.DBAPIError:
+        return None
+
+
+def has_tables(engine):
+    return engine.has_table('machines')
+
+
+def upgrade(engine, database):
+    """Bring the database at URL `database` up to SCHEMA_VERSION."""
+    from alembic import command
+    config = alembic_config(database)
+    if current_version(engine) is None and has_tables(engine):
+        # Tables were made by create_all, adopt them as the baseline
+        command.stamp(config, BASELINE_VERSION)
+    command.upgrade(config, 'head')
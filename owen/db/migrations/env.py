@@ -0,0 +1,34 @@
+""" Alembic environment for the owen ticket database. """
+from alembic import context
+from sqlalchemy import engine_from_config, pool
+
+from owen.db import models
+
+config = context.config
+target_metadata = models.Base.metadata
+
+
+def run_migrations_offline():
+    context.configure(url=config.get_main_option('sqlalchemy.url'),
+                      target_metadata=target_metadata)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    engine = engine_from_config(config.get_section(config.config_ini_section),
+                                prefix='sqlalchemy.', poolclass=pool.NullPool)
+    connection = engine.connect()
+    context.configure(connection=connection,
+                      target_metadata=target_metadata)
+    try:
+        with context.begin_transaction():
+            context.run_migrations()
+    finally:
+        connection.close()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,32 @@
+"""idempotency key for each outbox entry
+
+Revision ID: 1e8c5a2f7d63
+Revises: 4b7d0f6e91c2
+Create Date: 2026-10-18 19:30:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1e8c5a2f7d63'
+down_revision = '4b7d0f6e91c2'
+
+import uuid
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import table, column
+
+
+def upgrade():
+    op.add_column('submission_outbox',
+                  sa.Column('idempotency_key', sa.String))
+    outbox = table('submission_outbox', column('id', sa.Integer),
+                   column('idempotency_key', sa.String))
+    bind = op.get_bind()
+    for (id,) in bind.execute(sa.select([outbox.c.id])).fetchall():
+        bind.execute(outbox.update().where(outbox.c.id == id).
+                     values(idempotency_key=uuid.uuid4().hex))
+
+
+def downgrade():
+    op.drop_column('submission_outbox', 'idempotency_key')
@@ -0,0 +1,64 @@
+"""indexes and unique hostname and serial
+
+Revision ID: 2266a7407410
+Revises: 2f258cac8705
+Create Date: 2026-10-18 09:20:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2266a7407410'
+down_revision = '2f258cac8705'
+
+from alembic import op
+import sqlalchemy as sa
+
+from owen.db.migrate import MigrationError
+
+# (table, column, unique)
+INDEXES = [
+    ('machines', 'hostname', True),
+    ('machines', 'serial', True),
+    ('parts', 'fru', False),
+    ('part_requests', 'closed', False),
+    ('part_requests', 'machine_id', False),
+    ('part_requests', 'part_id', False),
+    ('part_requests', 'ticket_number', False),
+    ('part_requests', 'date_created', False),
+]
+
+
+def _duplicates(table, column):
+    "Lines describing the rows of table that share a value of column"
+    rows = op.get_bind().execute(sa.text(
+        "SELECT {1}, id FROM {0} WHERE {1} IN "
+        "(SELECT {1} FROM {0} GROUP BY {1} HAVING COUNT(*) > 1) "
+        "ORDER BY {1}, id".format(table, column))).fetchall()
+    ids = {}
+    for value, id in rows:
+        ids.setdefault(value, []).append(str(id))
+    return ["  %s.%s '%s': ids %s" % (table, column, value,
+                                       ', '.join(ids[value]))
+            for value in sorted(ids)]
+
+
+def upgrade():
+    # Checked before any index is made so that a failed upgrade can
+    # simply be run again once the rows are fixed
+    problems = []
+    for table, column, unique in INDEXES:
+        if unique:
+            problems.extend(_duplicates(table, column))
+    if problems:
+        raise MigrationError(
+            "Cannot make hostnames and serials unique, fix or delete these "
+            "duplicate machines first:\n" + '\n'.join(problems))
+    # Unique indexes stand in for constraints, which SQLite cannot ALTER in
+    for table, column, unique in INDEXES:
+        op.create_index('ix_%s_%s' % (table, column), table, [column],
+                        unique=unique)
+
+
+def downgrade():
+    for table, column, unique in INDEXES:
+        op.drop_index('ix_%s_%s' % (table, column))
@@ -0,0 +1,32 @@
+"""status sync columns
+
+Revision ID: 2f258cac8705
+Revises: d2e7781a5b06
+Create Date: 2026-10-18 09:10:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2f258cac8705'
+down_revision = 'd2e7781a5b06'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Databases built with create_all may already have these
+    inspector = sa.engine.reflection.Inspector.from_engine(op.get_bind())
+    columns = [c['name'] for c in inspector.get_columns('part_requests')]
+    if 'detail_hash' not in columns:
+        op.add_column('part_requests',
+                      sa.Column('detail_hash', sa.String(40)))
+    if 'sync_state' not in inspector.get_table_names():
+        op.create_table('sync_state',
+            sa.Column('name', sa.String, primary_key=True),
+            sa.Column('last_run', sa.DateTime))
+
+
+def downgrade():
+    op.drop_table('sync_state')
+    op.drop_column('part_requests', 'detail_hash')
@@ -0,0 +1,36 @@
+"""submission outbox
+
+Revision ID: 343062703ead
+Revises: 2266a7407410
+Create Date: 2026-10-18 10:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '343062703ead'
+down_revision = '2266a7407410'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('submission_outbox',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('part_request_id', sa.Integer,
+                  sa.ForeignKey('part_requests.id')),
+        sa.Column('delivered', sa.Boolean),
+        sa.Column('attempts', sa.Integer),
+        sa.Column('job_id', sa.String),
+        sa.Column('last_error', sa.String),
+        sa.Column('date_created', sa.DateTime),
+        sa.Column('date_attempted', sa.DateTime),
+        sa.Column('date_delivered', sa.DateTime))
+    op.create_index('ix_submission_outbox_part_request_id',
+                    'submission_outbox', ['part_request_id'])
+    op.create_index('ix_submission_outbox_delivered',
+                    'submission_outbox', ['delivered'])
+
+
+def downgrade():
+    op.drop_table('submission_outbox')
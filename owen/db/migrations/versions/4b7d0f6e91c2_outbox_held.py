@@ -0,0 +1,25 @@
+"""hold outbox entries for an operator
+
+Revision ID: 4b7d0f6e91c2
+Revises: 343062703ead
+Create Date: 2026-10-18 19:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b7d0f6e91c2'
+down_revision = '343062703ead'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import table, column
+
+
+def upgrade():
+    op.add_column('submission_outbox', sa.Column('held', sa.Boolean))
+    outbox = table('submission_outbox', column('held', sa.Boolean))
+    op.execute(outbox.update().values(held=False))
+
+
+def downgrade():
+    op.drop_column('submission_outbox', 'held')
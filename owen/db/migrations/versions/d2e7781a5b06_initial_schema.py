@@ -0,0 +1,43 @@
+"""initial schema
+
+Revision ID: d2e7781a5b06
+Revises: None
+Create Date: 2026-10-18 09:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd2e7781a5b06'
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('machines',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('hostname', sa.String),
+        sa.Column('machine_type', sa.String),
+        sa.Column('serial', sa.String))
+    op.create_table('parts',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('fru', sa.String),
+        sa.Column('description', sa.String))
+    op.create_table('part_requests',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('closed', sa.Boolean),
+        sa.Column('machine_id', sa.Integer, sa.ForeignKey('machines.id')),
+        sa.Column('part_id', sa.Integer, sa.ForeignKey('parts.id')),
+        sa.Column('part_count', sa.Integer),
+        sa.Column('ticket_number', sa.String),
+        sa.Column('status', sa.String),
+        sa.Column('date_created', sa.DateTime,
+                  server_default=sa.func.current_timestamp()),
+        sa.Column('date_closed', sa.DateTime))
+
+
+def downgrade():
+    op.drop_table('part_requests')
+    op.drop_table('parts')
+    op.drop_table('machines')
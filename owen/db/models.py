@@ -1,4 +1,5 @@
 """ owen.db.models - SQLAlchemy models for ticket info. """
+import uuid
 from datetime import datetime
 
 import sqlalchemy
@@ -14,9 +15,9 @@ class Machine(Base):
     __tablename__ = 'machines'
     
     id = Column(Integer, primary_key=True)
-    hostname = Column(String)
+    hostname = Column(String, unique=True, index=True)
     machine_type = Column(String)
-    serial = Column(String)
+    serial = Column(String, unique=True, index=True)
     
     def __repr__(self):
         return "<Machine('%s','%s','%s')>" % (
@@ -26,7 +27,7 @@ class Part(Base):
     __tablename__ = 'parts'
     
     id = Column(Integer, primary_key=True)
-    fru = Column(String)
+    fru = Column(String, index=True)
     description = Column(String) 
 
     def __repr__(self):
@@ -38,21 +39,61 @@ class PartRequest(Base):
     __tablename__ = 'part_requests'
 
     id = Column(Integer, primary_key=True)
-    closed = Column(Boolean, default=False)
-    machine_id = Column(Integer, ForeignKey('machines.id'))
+    closed = Column(Boolean, default=False, index=True)
+    machine_id = Column(Integer, ForeignKey('machines.id'), index=True)
     machine = relationship("Machine",
         backref=backref('part_requests', order_by=id))
-    part_id = Column(Integer, ForeignKey('parts.id'))
+    part_id = Column(Integer, ForeignKey('parts.id'), index=True)
     part = relationship("Part",
         backref=backref('requested', order_by=id))
     part_count = Column(Integer)
-    ticket_number = Column(String)
+    ticket_number = Column(String, index=True)
     status = Column(String)
+    detail_hash = Column(String(40))
     date_created = Column(DateTime,
-        default=datetime.now(),
-        server_default=sqlalchemy.sql.func.current_timestamp())
+        default=datetime.now,
+        server_default=sqlalchemy.sql.func.current_timestamp(),
+        index=True)
     date_closed  = Column(DateTime)
     
     def close(self):
         self.closed = True
         self.date_closed = datetime.now()
+
+
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+
+    name = Column(String, primary_key=True)
+    last_run = Column(DateTime)
+
+
+def new_key():
+    "Idempotency key no other submission, from any database, will have"
+    return uuid.uuid4().hex
+
+
+class OutboxEntry(Base):
+    """A PartRequest queued for the submission server.
+
+    `job_id` is set once the server accepts it, and `delivered` once
+    that job has placed the call. Entries that may have reached ESC
+    without being confirmed are `held` until an operator checks them.
+    Every attempt sends the entry's own `idempotency_key`.
+    """
+    __tablename__ = 'submission_outbox'
+
+    id = Column(Integer, primary_key=True)
+    part_request_id = Column(Integer, ForeignKey('part_requests.id'),
+                             index=True)
+    part_request = relationship("PartRequest",
+        backref=backref('submissions', order_by=id))
+    delivered = Column(Boolean, default=False, index=True)
+    held = Column(Boolean, default=False)
+    attempts = Column(Integer, default=0)
+    job_id = Column(String)
+    idempotency_key = Column(String, default=new_key)
+    last_error = Column(String)
+    date_created = Column(DateTime, default=datetime.now)
+    date_attempted = Column(DateTime)
+    date_delivered = Column(DateTime)
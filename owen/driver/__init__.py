@@ -0,0 +1,32 @@
+""" owen.driver - drivers for vendor service request systems. """
+import importlib
+
+from owen.driver import sessions
+
+DRIVERS = {
+    'selenium': 'owen.driver.ibm.ElectronicServiceRequest',
+    'http': 'owen.driver.ibm_http.ElectronicServiceRequestHTTP',
+}
+
+
+def load_driver(config, section='default'):
+    """Construct the ESC driver named by `esc_driver` in config."""
+    name = 'selenium'
+    if config.has_option(section, 'esc_driver'):
+        name = config.get(section, 'esc_driver')
+    if name not in DRIVERS:
+        raise ValueError("Unknown esc_driver: %s" % name)
+    module_name, class_name = DRIVERS[name].rsplit('.', 1)
+    driver_class = getattr(importlib.import_module(module_name), class_name)
+    kwargs = {'username': config.get(section, 'j_username'),
+              'password': config.get(section, 'j_password')}
+    if config.has_option(section, 'esc_url'):
+        kwargs['base_url'] = config.get(section, 'esc_url')
+    if config.has_option(section, 'esc_cache_ttl'):
+        kwargs['cache_ttl'] = config.getint(section, 'esc_cache_ttl')
+    kwargs['session_store'] = sessions.from_config(config, section,
+                                                   'esc_session_dir')
+    if name == 'selenium':
+        from owen import browser
+        kwargs['browser'] = browser.from_config(config)
+    return driver_class(**kwargs)
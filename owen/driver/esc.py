@@ -0,0 +1,248 @@
+"""
+esc.py - Helpers shared by the IBM Electronic Service Call drivers
+"""
+
+import collections
+import HTMLParser
+import Queue
+import re
+import threading
+import time
+import urlparse
+
+ESC_URL = "https://www-930.ibm.com/support/esc/"
+SIGNIN_PAGE = "signin.jsp"
+PLACECALL_PAGE = "placecall_upr.jsp"
+LIST_PAGE = "viewcalls.wss?view=selfreg"
+DETAIL_PAGE = "viewcalldetailtext.wss?callid=%s"
+STATUS_PAGE = "statusupdate.jsp?uniqcallid=%s&actionflag=%s&ibmnum=%s"
+COMMENT_PAGE = "additionalcomments.jsp?uniqcallid=%s&ibmnum=%s"
+
+# Error banner shown above a form that ESC refused
+ERROR_SELECTOR = ".ibm-error"
+
+_STATUS = re.compile(r"^\s*(?:Call )?Status\s*:\s*(\S.*?)\s*$", re.M | re.I)
+_PROBLEM_NUMBER = re.compile(r"[Pp]roblem [Nn]umber(?:\s|<[^>]*>|[:#]|is)*"
+                             r"([A-Z0-9]{5,})")
+
+
+class ESCError(Exception):
+    pass
+
+
+def is_signin(url):
+    "True if url is the ESC sign-in page"
+    return urlparse.urlparse(url).path.endswith('/' + SIGNIN_PAGE)
+
+
+def call_id(href):
+    "Extract the call id from a viewcalls.wss link"
+    match = re.match(".*callid=(.*)$", href)
+    return match.group(1) if match else None
+
+
+def find_problem_number(html):
+    "IBM problem number from a call confirmation page, or None"
+    match = _PROBLEM_NUMBER.search(html)
+    return match.group(1) if match else None
+
+
+def find_status(details):
+    "Call status from the text of a call detail page, or None"
+    match = _STATUS.search(details)
+    return match.group(1) if match else None
+
+
+# One row of the viewcalls.wss table. `cells` holds the text of every
+# column in header order.
+CallRow = collections.namedtuple('CallRow',
+                                 ['call_id', 'problem_number', 'cells'])
+
+
+class _CallTableParser(HTMLParser.HTMLParser):
+    """Single-pass parser for the first <table> of a call listing page."""
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.headers = None
+        self.rows = []
+        self._number_col = None
+        self._depth = 0
+        self._done = False
+        self._row = None
+        self._is_header = False
+        self._cell = None
+        self._call_id = None
+
+    def handle_starttag(self, tag, attrs):
+        if self._done:
+            return
+        if tag == 'table':
+            self._depth += 1
+        elif self._depth != 1:
+            return
+        elif tag == 'tr':
+            self._row = []
+            self._is_header = False
+            self._call_id = None
+        elif tag in ('td', 'th') and self._row is not None:
+            self._cell = []
+            self._is_header = self._is_header or tag == 'th'
+        elif tag == 'a' and self._row is not None:
+            attrs = dict(attrs)
+            if attrs.get('name') == 'count' and attrs.get('href'):
+                self._call_id = call_id(attrs['href'])
+
+    def handle_endtag(self, tag):
+        if self._done:
+            return
+        if tag == 'table':
+            self._depth -= 1
+            self._done = self._depth == 0
+        elif self._depth != 1:
+            return
+        elif tag in ('td', 'th') and self._cell is not None:
+            self._row.append(u' '.join(u''.join(self._cell).split()))
+            self._cell = None
+        elif tag == 'tr' and self._row is not None:
+            self._end_row()
+
+    def _end_row(self):
+        row, self._row = tuple(self._row), None
+        if self.headers is None:
+            if self._is_header:
+                self.headers = row
+                if 'IBM problem number' in row:
+                    self._number_col = row.index('IBM problem number')
+            return
+        number = None
+        if self._number_col is not None and self._number_col < len(row):
+            number = row[self._number_col]
+        self.rows.append(CallRow(self._call_id, number, row))
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape('&%s;' % name))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape('&#%s;' % name))
+
+
+def iter_calls(html):
+    """Yield a CallRow for each call in a viewcalls.wss page.
+
+    `html` is either the whole page or an iterable of chunks of it, so
+    rows can be produced while the page is still being downloaded.
+    """
+    if isinstance(html, basestring):
+        html = [html]
+    parser = _CallTableParser()
+    for chunk in html:
+        parser.feed(chunk)
+        rows, parser.rows = parser.rows, []
+        for row in rows:
+            yield row
+        if parser._done:
+            return
+    parser.close()
+    for row in parser.rows:
+        yield row
+
+
+# Outcome of fetching one call's details. Exactly one of `details` and
+# `error` is set.
+DetailResult = collections.namedtuple('DetailResult',
+                                      ['call_id', 'details', 'error'])
+
+
+def fetch_concurrently(ids, concurrency, open_fetcher):
+    """Fetch call details on `concurrency` threads, yielding DetailResults.
+
+    open_fetcher(n) is called once in each worker thread and returns a
+    (fetch, close) pair: fetch(call_id) returns the detail text and
+    close() releases whatever the worker opened. Results are yielded in
+    the order they complete; a failure only affects its own call.
+    """
+    ids = list(ids)
+    todo = Queue.Queue()
+    for id in ids:
+        todo.put(id)
+    done = Queue.Queue()
+
+    def work(n):
+        try:
+            fetch, close = open_fetcher(n)
+        except Exception as e:
+            fetch, close = None, None
+            error = e
+        try:
+            while True:
+                try:
+                    id = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                if fetch is None:
+                    done.put(DetailResult(id, None, error))
+                    continue
+                try:
+                    done.put(DetailResult(id, fetch(id), None))
+                except Exception as e:
+                    done.put(DetailResult(id, None, e))
+        finally:
+            if close is not None:
+                close()
+
+    for n in range(min(max(1, concurrency), len(ids))):
+        worker = threading.Thread(target=work, args=(n,))
+        worker.daemon = True
+        worker.start()
+    for i in range(len(ids)):
+        yield done.get()
+
+
+class CallIndex(object):
+    """Cached listing of ESC calls, indexed by call id and problem number.
+
+    `load` returns a list of (call id, IBM problem number) pairs. The
+    listing is reloaded once it is older than `ttl` seconds or after
+    invalidate() has been called.
+    """
+    def __init__(self, load, ttl=300):
+        self._load = load
+        self.ttl = ttl
+        self._calls = None
+        self._loaded = 0
+        self._by_id = {}
+        self._by_number = {}
+
+    def refresh(self):
+        calls = self._load()
+        self._calls = calls
+        self._loaded = time.time()
+        self._by_id = dict(calls)
+        self._by_number = dict((num, id) for id, num in calls)
+        return calls
+
+    def invalidate(self):
+        self._calls = None
+
+    def calls(self):
+        if self._calls is None or time.time() - self._loaded > self.ttl:
+            return self.refresh()
+        return self._calls
+
+    def by_id(self, id):
+        "(call id, problem number) for a call id, or None"
+        self.calls()
+        if id not in self._by_id:
+            return None
+        return (id, self._by_id[id])
+
+    def by_number(self, number):
+        "(call id, problem number) for an IBM problem number, or None"
+        self.calls()
+        if number not in self._by_number:
+            return None
+        return (self._by_number[number], number)
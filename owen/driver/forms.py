@@ -0,0 +1,127 @@
+"""
+forms.py - Fill in ESC forms through a Selenium WebDriver
+
+All fields are set by one script call rather than typed in one key at
+a time, with typing kept as a fallback for fields that need it.
+"""
+
+from owen.driver import esc
+
+# Sets each field named by id (or failing that by name) and fires the
+# events a user's typing would. A select takes the option whose value
+# or label is given. Returns the ids that were not found and those
+# whose value did not stick.
+_FILL_SCRIPT = """
+var values = arguments[0], missing = [], failed = [];
+function fire(el, type) {
+    var event = document.createEvent('HTMLEvents');
+    event.initEvent(type, true, true);
+    el.dispatchEvent(event);
+}
+function label(option) {
+    return option.text.replace(/\\s+/g, ' ').trim();
+}
+function set(el, value) {
+    if (el.tagName == 'SELECT') {
+        for (var i = 0; i < el.options.length; i++) {
+            if (el.options[i].value == value ||
+                    label(el.options[i]) == value) {
+                el.selectedIndex = i;
+                return;
+            }
+        }
+    }
+    el.value = value;
+}
+function holds(el, value) {
+    if (el.value == value) {
+        return true;
+    }
+    return el.tagName == 'SELECT' && el.selectedIndex >= 0 &&
+        label(el.options[el.selectedIndex]) == value;
+}
+for (var id in values) {
+    var el = document.getElementById(id) || document.getElementsByName(id)[0];
+    if (!el) {
+        missing.push(id);
+        continue;
+    }
+    fire(el, 'focus');
+    set(el, values[id]);
+    fire(el, 'input');
+    fire(el, 'change');
+    fire(el, 'blur');
+    if (!holds(el, values[id])) {
+        failed.push(id);
+    }
+}
+return {missing: missing, failed: failed};
+"""
+
+
+class FormError(esc.ESCError):
+    def __init__(self, missing, unset):
+        self.missing = missing
+        self.unset = unset
+        problems = []
+        if missing:
+            problems.append("no element with id: %s" % ', '.join(missing))
+        if unset:
+            problems.append("value not accepted for: %s" % ', '.join(unset))
+        esc.ESCError.__init__(self, "Form not filled, " + '; '.join(problems))
+
+
+def _text(value):
+    if value is None:
+        return u''
+    if isinstance(value, basestring):
+        return value
+    return unicode(value)
+
+
+def _find(driver, id):
+    elements = driver.find_elements_by_id(id) or \
+        driver.find_elements_by_name(id)
+    return elements[0] if elements else None
+
+
+def _holds(el, text):
+    "True if el's value, or for a select its chosen option's label, is text"
+    if el.get_attribute('value') == text:
+        return True
+    if el.tag_name.lower() != 'select':
+        return False
+    return any(option.text.strip() == text.strip()
+               for option in el.find_elements_by_tag_name('option')
+               if option.is_selected())
+
+
+def fill_form(driver, data, typed=()):
+    """Fill in the fields of the current page named by the keys of data.
+
+    Every field is set in a single script call. Fields listed in
+    `typed`, and any whose value did not stick, are typed in with
+    send_keys instead. Raises FormError naming the ids that are
+    missing from the page or that still do not hold their value.
+    """
+    values = dict((id, _text(value)) for id, value in data.iteritems())
+    scripted = dict((id, text) for id, text in values.iteritems()
+                    if id not in typed)
+    missing, unset = [], []
+    retry = [id for id in typed if id in values]
+    if scripted:
+        result = driver.execute_script(_FILL_SCRIPT, scripted)
+        missing.extend(result['missing'])
+        retry.extend(result['failed'])
+    for id in retry:
+        el = _find(driver, id)
+        if el is None:
+            missing.append(id)
+            continue
+        if el.tag_name.lower() in ('input', 'textarea'):
+            el.clear()
+        el.send_keys(values[id])
+        if not _holds(el, values[id]):
+            unset.append(id)
+    if missing or unset:
+        raise FormError(sorted(missing), sorted(unset))
@@ -3,83 +3,121 @@ ibm.py - API into IBM Electronic Service Call Data
 """
 
 import re
-from BeautifulSoup import BeautifulSoup
-from selenium import webdriver
-from selenium.webdriver.common.keys import Keys
 
+from owen.browser import BrowserFactory
 from owen.driver.api import ServiceRequestDriver, ServiceRequestTicket
 from owen.driver.api import ExtendedAction
+from owen.driver import esc
+from owen.driver.forms import fill_form
+from owen.driver import sessions
+from owen import metrics
 
-def _fill_form(driver, data):
-    "Helper function to fill form"
-    for id,text in data.iteritems():
-        el = driver.find_element_by_id(id)
-        if not el:
-            raise Execption("Element not found with id: {}".format(id))
-        el.send_keys(text)
-
-def _get_table(soup_table):
-    headers = None
-    rows = []
-    for row in soup_table.findAll('tr'):
-        if headers == None:
-            headers = [ h.text for h in row.findAll('th') ]
-        else:
-            row = [ r.text for r in row.findAll('td') ]
-            rows.append(dict(map(None, headers,row)))
-    return rows
-
-def _get_soup(driver):
-    raw = unicode(driver.page_source).encode('utf-8')
-    return BeautifulSoup(raw)
+def _load(driver, url, step):
+    "Load an ESC page, timed as `step`"
+    with metrics.span(step):
+        driver.get(url)
 
 
-class ElectronicServiceRequest(ServiceReuqestDriver):
+class ElectronicServiceRequest(ServiceRequestDriver):
     """Class for managing initial interactions with ESC"""
-    def __init__(self, username=None, password=None, driver=None):
+    def __init__(self, username=None, password=None, driver=None,
+                 base_url=esc.ESC_URL, cache_ttl=300, session_store=None,
+                 browser=None):
+        self.browser = browser or BrowserFactory()
         if not driver:
-            driver = webdriver.Firefox()
+            driver = self.browser()
         self.driver = driver
         self.username = username
         self.password = password
-        # TODO(devoid): Make login a basic check?
-        self._login()
-
-    def _login(self):
-        self.driver.get("https://www-930.ibm.com/support/esc/signin.jsp")
-        _fill_form(self.driver, {'j_username' : self.username,
-                                 'j_password' : self.password,})
-        self.driver.find_element_by_name('ibm-submit').click()
+        self.base_url = base_url
+        self.calls = esc.CallIndex(self._list_requests, ttl=cache_ttl)
+        self.store = session_store
+        saved = self.store and self.store.load(self.username)
+        if saved:
+            # Checked on the first page load, which signs in if needed
+            sessions.use_browser_cookies(self.driver, saved, self.base_url)
+        else:
+            self._login()
+
+    def _sign_in(self, driver):
+        _load(driver, self.base_url + esc.SIGNIN_PAGE, 'esc_signin')
+        fill_form(driver, {'j_username' : self.username,
+                            'j_password' : self.password,})
+        with metrics.span('esc_login'):
+            driver.find_element_by_name('ibm-submit').click()
+        return driver.get_cookies()
+
+    def _login(self, driver=None):
+        driver = driver or self.driver
+        sessions.login_browser(self.store, driver, self.username,
+                               lambda: self._sign_in(driver), self.base_url)
+
+    def _get(self, page, step, driver=None):
+        "Load an ESC page, signing in again if ESC asks us to"
+        driver = driver or self.driver
+        _load(driver, self.base_url + page, step)
+        if esc.is_signin(driver.current_url) and page != esc.SIGNIN_PAGE:
+            self._login(driver)
+            _load(driver, self.base_url + page, step)
+
+    def _details(self, id, driver=None):
+        driver = driver or self.driver
+        self._get(esc.DETAIL_PAGE % (id), 'esc_detail', driver)
+        return driver.find_element_by_tag_name("body").text
 
     def _list_requests(self):
-        self.driver.get("https://www-930.ibm.com/support/esc/"
-                        "viewcalls.wss?view=selfreg")
-        soup = _get_soup(self.driver)
-        rows = _get_table(soup.find('table'))
-        ticket_nums = [ row["IBM problem number"] for row in rows ]
-        ticket_ids = []
-        for el in self.driver.find_elements_by_name("count"):
-            href = el.get_attribute('href') 
-            match = re.match(".*callid=(.*)$", href)
-            ticket_ids.append(match.group(1))
-        assert len(ticket_nums) == len(ticket_ids) 
-        return zip(ticket_ids, ticket_nums)
+        self._get(esc.LIST_PAGE, 'esc_list')
+        return [ (row.call_id, row.problem_number)
+                 for row in esc.iter_calls(self.driver.page_source)
+                 if row.call_id ]
+
+    def refresh(self):
+        "Reload the cached listing of calls from ESC."
+        self.calls.refresh()
 
     def get_request(self, id):
-        reqs = self._list_requests()
-        for req_id, req_case in reqs:
-            if id == req_id:
-                return IBMServiceTicket(req_id, req_case, self.driver)
-        return None
+        req = self.calls.by_id(id)
+        if req is None:
+            return None
+        return IBMServiceTicket(req[0], req[1], self)
+
+    def get_request_by_number(self, number):
+        "Returns the request with the given IBM problem number."
+        req = self.calls.by_number(number)
+        if req is None:
+            return None
+        return IBMServiceTicket(req[0], req[1], self)
 
     def list_requests(self):
         "Returns a list of request objects."
-        reqs = self._list_requests()
         tickets = []
-        for req_id, req_case in reqs:
-            tickets.append(IBMServiceTicket(req_id, req_case, self.driver))
+        for req_id, req_case in self.calls.calls():
+            tickets.append(IBMServiceTicket(req_id, req_case, self))
         return tickets
 
+    def _detail_fetcher(self, n):
+        # The first worker borrows our driver, the rest log in their own
+        if n == 0:
+            driver = self.driver
+            close = lambda: None
+        else:
+            driver = self.browser()
+            close = driver.quit
+            try:
+                self._login(driver)
+            except Exception:
+                close()
+                raise
+        return (lambda id: self._details(id, driver), close)
+
+    def fetch_details(self, ids, concurrency=2):
+        """Yield an esc.DetailResult for each call id as it is fetched.
+
+        Up to `concurrency` browsers load detail pages at once. Our own
+        driver is one of them, so do not use it until this is exhausted.
+        """
+        return esc.fetch_concurrently(ids, concurrency, self._detail_fetcher)
+
     def _handle_after_hours_popup(self, form_win):
         # Find the popup window
         windows = self.driver.window_handles
@@ -101,8 +139,7 @@ class ElectronicServiceRequest(ServiceReuqestDriver):
 
     def create_request(self, product=None, model=None, serial=None, part=None,
                        comments = None):
-        self.driver.get("https://www-930.ibm.com/support/esc/"
-                        "placecall_upr.jsp")
+        self._get(esc.PLACECALL_PAGE, 'esc_placecall')
         # TODO(devoid): default model is probably bad
         if not model:
             model = 'AC1'
@@ -127,27 +164,31 @@ class ElectronicServiceRequest(ServiceReuqestDriver):
         }
         if part:
             form_entries["Part_Number"] = part
-        fill_form(self.driver, form_entries)
+        with metrics.span('esc_fill_form'):
+            fill_form(self.driver, form_entries)
         # Before we submit, capture the current window handle
         form_window = self.driver.current_window_handle
         # Click submit button
-        elem = self.driver.find_element_by_name("ibm-submit")
-        elem.click()
+        with metrics.span('esc_submit'):
+            elem = self.driver.find_element_by_name("ibm-submit")
+            elem.click()
         # There may be a popup for after-hours stuff
-        self._handle_after_hours_popup(form_window)
+        with metrics.span('esc_popup'):
+            self._handle_after_hours_popup(form_window)
+        self.calls.invalidate()
 
 
 class IBMServiceTicket(ServiceRequestTicket):
     """Class for dealing with a specific ticket"""
-    def __init__(self, id, ticket, driver):
+    def __init__(self, id, ticket, esr):
         self.id = id
         self.ticket = ticket
-        self.driver = driver
+        self.esr = esr
+        self.driver = esr.driver
+        self.base_url = esr.base_url
 
     def details(self):
-        self.driver.get("https://www-930.ibm.com/support/esc/"
-                        "viewcalldetailtext.wss?callid=%s" % (self.id))
-        return self.driver.find_element_by_tag_name("body").text
+        return self.esr._details(self.id)
 
     def third_party_status(self):
         raise NotImplementedError()
@@ -158,21 +199,23 @@ class IBMServiceTicket(ServiceRequestTicket):
     def _submit_comment(self, comment):
         if len(comment) > 150:
             comment = comment[:149]
-        _fill_form(self.driver, {'Comments' : comment })
+        fill_form(self.driver, {'Comments' : comment })
         self.driver.find_element_by_name('ibm-submit').click()
         return True
 
     def _update_state(self, state, comment):
-        self.driver.get("https://www-930.ibm.com/support/esc/"
-                        "statusupdate.jsp?uniqcallid=%s&actionflag=%s"
-                        "&ibmnum=%s" % (state, self.id, self.ticket))
-        return self._submit_comment(comment)
+        self.esr._get(esc.STATUS_PAGE % (self.id, state, self.ticket),
+                      'esc_status')
+        done = self._submit_comment(comment)
+        self.esr.calls.invalidate()
+        return done
 
     def add_info(self, comment):
-        self.driver.get("https://www-930.ibm.com/support/esc/"
-                        "additionalcomments.jsp?uniqcallid=%s&ibmnum=%s"
-                        % (self.id, self.ticket))
-        return self._submit_comment(comment)
+        self.esr._get(esc.COMMENT_PAGE % (self.id, self.ticket),
+                      'esc_comment')
+        done = self._submit_comment(comment)
+        self.esr.calls.invalidate()
+        return done
     
     def cancel_request(self, comment):
         return self._update_state('CA', comment)
@@ -0,0 +1,278 @@
+"""
+ibm_http.py - API into IBM Electronic Service Call Data over plain HTTP
+
+Same operations as ibm.py, but posts the ESC forms directly over a
+keep-alive connection instead of driving a browser.
+"""
+
+import re
+import threading
+import urlparse
+
+import requests
+from BeautifulSoup import BeautifulSoup
+
+from owen.driver.api import ServiceRequestDriver, ServiceRequestTicket
+from owen.driver import esc
+from owen.driver import sessions
+
+_SKIP_INPUTS = ('submit', 'button', 'image', 'reset', 'file')
+
+
+def _find_form(soup, field):
+    "Return the form containing an element with id or name `field`"
+    for form in soup.findAll('form'):
+        if form.find(attrs={'id': field}) or form.find(attrs={'name': field}):
+            return form
+    raise esc.ESCError("No form found with field: %s" % field)
+
+
+def _form_data(form):
+    "Collect the values a browser would submit for an untouched form"
+    data = {}
+    for el in form.findAll(['input', 'select', 'textarea']):
+        name = el.get('name')
+        if not name:
+            continue
+        if el.name == 'input':
+            kind = (el.get('type') or 'text').lower()
+            if kind in _SKIP_INPUTS:
+                continue
+            if kind in ('checkbox', 'radio') and not el.get('checked'):
+                continue
+            data[name] = el.get('value') or ''
+        elif el.name == 'select':
+            option = el.find('option', selected=True) or el.find('option')
+            if option:
+                data[name] = option.get('value') or option.text
+        else:
+            data[name] = el.text
+    return data
+
+
+def _fill_form(form, values):
+    "Form data with `values` set on the elements they name by id"
+    data = _form_data(form)
+    for id, text in values.iteritems():
+        el = form.find(attrs={'id': id}) or form.find(attrs={'name': id})
+        if not el:
+            raise esc.ESCError("Element not found with id: %s" % id)
+        if text is None:
+            text = ''
+        data[el.get('name') or id] = text
+    submit = form.find(attrs={'name': 'ibm-submit'})
+    if submit:
+        data['ibm-submit'] = submit.get('value') or ''
+    return data
+
+
+class ElectronicServiceRequestHTTP(ServiceRequestDriver):
+    """ESC driver that talks HTTP directly, without a browser"""
+    def __init__(self, username=None, password=None, base_url=esc.ESC_URL,
+                 timeout=30, pool_size=4, cache_ttl=300,
+                 session_store=None):
+        self.username = username
+        self.password = password
+        self.base_url = base_url
+        self.timeout = timeout
+        self.calls = esc.CallIndex(self._list_requests, ttl=cache_ttl)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.store = session_store
+        # Detail fetches share the session; one thread signs in at a time
+        self._login_lock = threading.Lock()
+        self._logins = 0
+        saved = self.store and self.store.load(self.username)
+        if saved:
+            # Checked on the first page load, which signs in if needed
+            sessions.set_requests_cookies(self.session.cookies, saved)
+        else:
+            self._login()
+
+    def _soup(self, rsp):
+        return BeautifulSoup(rsp.content)
+
+    def _get(self, page, stream=False):
+        logins = self._logins
+        rsp = self.session.get(self.base_url + page, timeout=self.timeout,
+                               stream=stream)
+        rsp.raise_for_status()
+        if esc.is_signin(rsp.url) and page != esc.SIGNIN_PAGE:
+            # Our session cookie expired, sign in again and retry
+            rsp.close()
+            self._login(logins)
+            rsp = self.session.get(self.base_url + page,
+                                   timeout=self.timeout, stream=stream)
+            rsp.raise_for_status()
+        return rsp
+
+    def _submit(self, rsp, field, values):
+        "Fill in and submit the form on page `rsp` containing `field`"
+        form = _find_form(self._soup(rsp), field)
+        data = _fill_form(form, values)
+        url = urlparse.urljoin(rsp.url, form.get('action') or rsp.url)
+        if (form.get('method') or 'get').lower() == 'post':
+            rsp = self.session.post(url, data=data, timeout=self.timeout)
+        else:
+            rsp = self.session.get(url, params=data, timeout=self.timeout)
+        rsp.raise_for_status()
+        return rsp
+
+    def _sign_in(self):
+        self.session.cookies.clear()
+        rsp = self._get(esc.SIGNIN_PAGE)
+        rsp = self._submit(rsp, 'j_username',
+                           {'j_username': self.username,
+                            'j_password': self.password})
+        if self._soup(rsp).find(attrs={'name': 'j_password'}):
+            raise esc.ESCError("ESC login failed for %s" % self.username)
+        return sessions.requests_cookies(self.session.cookies)
+
+    def _login(self, logins=None):
+        """Sign in, unless another thread has done so since the
+        `logins`th sign-in, when the request that found our session
+        expired was made."""
+        with self._login_lock:
+            if logins is not None and logins != self._logins:
+                return
+            if self.store is None:
+                self._sign_in()
+            else:
+                stale = sessions.requests_cookies(self.session.cookies)
+                cookies = self.store.refresh(self.username, stale,
+                                             self._sign_in)
+                sessions.set_requests_cookies(self.session.cookies, cookies)
+            self._logins += 1
+
+    def _list_requests(self):
+        rsp = self._get(esc.LIST_PAGE, stream=True)
+        try:
+            chunks = rsp.iter_content(16384, decode_unicode=True)
+            return [ (row.call_id, row.problem_number)
+                     for row in esc.iter_calls(chunks) if row.call_id ]
+        finally:
+            rsp.close()
+
+    def refresh(self):
+        "Reload the cached listing of calls from ESC."
+        self.calls.refresh()
+
+    def get_request(self, id):
+        req = self.calls.by_id(id)
+        if req is None:
+            return None
+        return IBMHTTPServiceTicket(req[0], req[1], self)
+
+    def get_request_by_number(self, number):
+        "Returns the request with the given IBM problem number."
+        req = self.calls.by_number(number)
+        if req is None:
+            return None
+        return IBMHTTPServiceTicket(req[0], req[1], self)
+
+    def list_requests(self):
+        "Returns a list of request objects."
+        return [ IBMHTTPServiceTicket(req_id, req_case, self)
+                 for req_id, req_case in self.calls.calls() ]
+
+    def _detail_fetcher(self, n):
+        # Workers share our session, which keeps pool_size connections
+        fetch = lambda id: IBMHTTPServiceTicket(id, None, self).details()
+        return (fetch, None)
+
+    def fetch_details(self, ids, concurrency=4):
+        "Yield an esc.DetailResult for each call id as it is fetched."
+        return esc.fetch_concurrently(ids, concurrency, self._detail_fetcher)
+
+    def _handle_after_hours_popup(self, rsp):
+        # The browser shows this as a popup, here it is just the next page
+        form_soup = self._soup(rsp)
+        el = form_soup.find(attrs={'id': 'Status_TypeA'})
+        if not el:
+            return rsp
+        form = _find_form(form_soup, 'Status_TypeA')
+        data = _fill_form(form, {})
+        data[el.get('name') or 'Status_Type'] = el.get('value') or 'on'
+        url = urlparse.urljoin(rsp.url, form.get('action') or rsp.url)
+        rsp = self.session.post(url, data=data, timeout=self.timeout)
+        rsp.raise_for_status()
+        return rsp
+
+    def create_request(self, product=None, model=None, serial=None, part=None,
+                       comments = None):
+        rsp = self._get(esc.PLACECALL_PAGE)
+        if not model:
+            model = 'AC1'
+        if re.match(".*AC1$",  product):
+            product = product[:len(product)-3]
+
+        form_entries = {
+            "Customer_Name" : "Argonne Nat. Lab",
+            "CustPhoneNumber" : "6302522000",
+            "Street" : "9700 S. Cass Ave",
+            "City" : "Argonne",
+            "State" : "Illinois",
+            "Zip" : "60439",
+            "Contact_Location" : "Bldg. 240",
+            "ContactName" : "Scott Devoid",
+            "ContPhoneNumber" : "6302521105",
+            "Product" : product,
+            "Model" : model,
+            "Serial_Number" : serial,
+            "Comments" : comments, # limited to 150 char
+        }
+        if part:
+            form_entries["Part_Number"] = part
+        rsp = self._submit(rsp, 'Serial_Number', form_entries)
+        rsp = self._handle_after_hours_popup(rsp)
+        self.calls.invalidate()
+        problem_number = esc.find_problem_number(rsp.text)
+        if not problem_number:
+            raise esc.ESCError("No problem number on ESC confirmation page")
+        return problem_number
+
+
+class IBMHTTPServiceTicket(ServiceRequestTicket):
+    """Class for dealing with a specific ticket over HTTP"""
+    def __init__(self, id, ticket, esr):
+        self.id = id
+        self.ticket = ticket
+        self.esr = esr
+
+    def details(self):
+        soup = self.esr._soup(self.esr._get(esc.DETAIL_PAGE % (self.id)))
+        body = soup.body or soup
+        return body.getText('\n')
+
+    def third_party_status(self):
+        raise NotImplementedError()
+
+    def case_number(self):
+        return self.ticket
+
+    def _submit_comment(self, rsp, comment):
+        if len(comment) > 150:
+            comment = comment[:149]
+        self.esr._submit(rsp, 'Comments', {'Comments' : comment })
+        return True
+
+    def _update_state(self, state, comment):
+        rsp = self.esr._get(esc.STATUS_PAGE % (self.id, state, self.ticket))
+        done = self._submit_comment(rsp, comment)
+        self.esr.calls.invalidate()
+        return done
+
+    def add_info(self, comment):
+        rsp = self.esr._get(esc.COMMENT_PAGE % (self.id, self.ticket))
+        done = self._submit_comment(rsp, comment)
+        self.esr.calls.invalidate()
+        return done
+
+    def cancel_request(self, comment):
+        return self._update_state('CA', comment)
+
+    def call_back_request(self, comment):
+        return self._update_state('CB', comment)
@@ -0,0 +1,162 @@
+"""
+sessions.py - ESC login cookies saved on disk and shared between processes
+
+Each username gets a JSON file of cookies. Files are replaced atomically
+so they can be read without locking; logging in takes an exclusive
+flock on a per-user lock file, so that when a saved session expires
+only one process signs in again and the others pick up its cookies.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from owen.driver import esc
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.owen', 'esc-sessions')
+
+_FIELDS = ('name', 'value', 'domain', 'path', 'secure', 'expiry')
+
+
+class SessionStore(object):
+    """Saved ESC cookies for each username, kept under `path`"""
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+
+    def _file(self, username, suffix):
+        name = hashlib.sha1((username or '').encode('utf-8')).hexdigest()
+        return os.path.join(self.path, name + suffix)
+
+    def _ensure_dir(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0700)
+
+    @contextlib.contextmanager
+    def lock(self, username):
+        "Hold the exclusive login lock for username"
+        self._ensure_dir()
+        fd = os.open(self._file(username, '.lock'),
+                     os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def load(self, username):
+        "Unexpired cookies saved for username, or None"
+        try:
+            with open(self._file(username, '.json')) as f:
+                cookies = json.load(f)
+        except (IOError, ValueError):
+            return None
+        now = time.time()
+        cookies = [c for c in cookies
+                   if not c.get('expiry') or c['expiry'] > now]
+        return cookies or None
+
+    def save(self, username, cookies):
+        self._ensure_dir()
+        cookies = [dict((k, c.get(k)) for k in _FIELDS) for c in cookies]
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cookies, f)
+            os.rename(tmp, self._file(username, '.json'))
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def refresh(self, username, stale, sign_in):
+        """Cookies to use after the `stale` ones stopped working.
+
+        If another process saved newer cookies for username they are
+        returned; otherwise sign_in() is called, under the login lock,
+        to log in and return fresh cookies, which are saved.
+        """
+        used = set((c['name'], c['value']) for c in stale or [])
+        with self.lock(username):
+            saved = self.load(username)
+            if saved and not set((c['name'], c['value'])
+                                 for c in saved) <= used:
+                return saved
+            cookies = sign_in()
+            self.save(username, cookies)
+            return cookies
+
+    def clear(self, username):
+        try:
+            os.unlink(self._file(username, '.json'))
+        except OSError:
+            pass
+
+
+def from_config(config, section, option):
+    """SessionStore at the directory named by option, the default
+    directory if it is not set, or None if it is set but empty."""
+    if not config.has_option(section, option):
+        return SessionStore()
+    path = config.get(section, option)
+    if not path:
+        return None
+    return SessionStore(os.path.expanduser(path))
+
+
+def requests_cookies(jar):
+    "Cookies of a requests cookie jar in the store's format"
+    return [{'name': c.name, 'value': c.value, 'domain': c.domain,
+             'path': c.path, 'secure': c.secure, 'expiry': c.expires}
+            for c in jar]
+
+
+def set_requests_cookies(jar, cookies):
+    jar.clear()
+    for c in cookies:
+        jar.set(c['name'], c['value'], domain=c.get('domain') or '',
+                path=c.get('path') or '/', secure=bool(c.get('secure')),
+                expires=c.get('expiry'))
+
+
+def set_browser_cookies(driver, cookies):
+    """Add cookies to a Selenium driver, which must already be showing
+    a page on the ESC host. Cookies the browser refuses are skipped."""
+    driver.delete_all_cookies()
+    for c in cookies:
+        cookie = dict((k, v) for k, v in c.iteritems() if v is not None)
+        try:
+            driver.add_cookie(cookie)
+        except Exception:
+            pass
+
+
+def use_browser_cookies(driver, cookies, base_url=esc.ESC_URL):
+    """Add cookies to a Selenium driver, first loading the sign-in page
+    at base_url unless the driver is showing a page there."""
+    # Cookies can only be set on a page of their own site
+    if not driver.current_url.startswith(base_url):
+        driver.get(base_url + esc.SIGNIN_PAGE)
+    set_browser_cookies(driver, cookies)
+
+
+def login_browser(store, driver, username, sign_in, base_url=esc.ESC_URL):
+    """Log a Selenium driver in to ESC as username.
+
+    sign_in() signs in with the driver and returns its cookies. With a
+    SessionStore as `store` that is only done if no other browser has
+    saved newer cookies, which are used instead.
+    """
+    if store is None:
+        sign_in()
+        return
+    signed_in = []
+    def tracked_sign_in():
+        signed_in.append(True)
+        return sign_in()
+    cookies = store.refresh(username, driver.get_cookies(), tracked_sign_in)
+    if not signed_in:
+        # Another browser logged in while our cookies were stale
+        use_browser_cookies(driver, cookies, base_url)
@@ -0,0 +1,141 @@
+""" owen.jobs - background queue for ticket submissions. """
+import logging
+import Queue
+import threading
+import time
+import uuid
+
+LOG = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+class Job(object):
+    def __init__(self, func, args=(), kwargs=None):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def run(self):
+        self.status = RUNNING
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+            self.status = SUCCEEDED
+        except Exception as e:
+            LOG.exception("Job %s failed", self.id)
+            self.error = str(e) or e.__class__.__name__
+            # Added to the job's status, e.g. how far a call got
+            self.result = getattr(e, 'details', None)
+            self.status = FAILED
+        self.finished = time.time()
+
+    def done(self):
+        return self.status in (SUCCEEDED, FAILED)
+
+    def to_dict(self):
+        d = {'id': self.id,
+             'status': self.status,
+             'error': self.error,
+             'created': self.created,
+             'finished': self.finished}
+        if isinstance(self.result, dict):
+            d.update(self.result)
+        return d
+
+
+class JobQueue(object):
+    """Runs submitted callables on a fixed pool of worker threads.
+
+    Finished jobs are kept for `retention` seconds so their status
+    can still be looked up. Jobs submitted with a key are shared by
+    later submissions with the same key while they are queued or
+    running, and for `dedupe_window` seconds after they succeed; they
+    are kept at least that long.
+    """
+    def __init__(self, workers=2, retention=3600, dedupe_window=3600):
+        self.retention = retention
+        self.dedupe_window = dedupe_window
+        self._queue = Queue.Queue()
+        self._jobs = {}
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                job.run()
+            finally:
+                self._queue.task_done()
+
+    def _expire(self):
+        now = time.time()
+        for key, job in self._keys.items():
+            if job.status == FAILED or (
+                    job.done() and job.finished < now - self.dedupe_window):
+                del self._keys[key]
+        # A job still handed out for its key must stay visible
+        keyed = set(job.id for job in self._keys.itervalues())
+        for job_id, job in self._jobs.items():
+            if (job.done() and job.finished < now - self.retention and
+                    job_id not in keyed):
+                del self._jobs[job_id]
+
+    def submit(self, func, *args, **kwargs):
+        return self.submit_keyed(None, func, *args, **kwargs)
+
+    def submit_keyed(self, key, func, *args, **kwargs):
+        """Queue func unless a live job was already submitted with key.
+
+        Returns the new job, or the existing one for a repeated key.
+        """
+        with self._lock:
+            self._expire()
+            if key is not None and key in self._keys:
+                return self._keys[key]
+            job = Job(func, args, kwargs)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._keys[key] = job
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def join(self, timeout=None):
+        """Wait for every submitted job to finish.
+
+        Returns False if jobs were still queued or running after
+        `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        done = self._queue.all_tasks_done
+        with done:
+            while self._queue.unfinished_tasks:
+                if deadline is None:
+                    done.wait()
+                elif deadline <= time.time():
+                    return False
+                else:
+                    done.wait(deadline - time.time())
+        return True
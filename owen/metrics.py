@@ -0,0 +1,167 @@
+""" owen.metrics - timing spans and counters in Prometheus text format. """
+import contextlib
+import json
+import logging
+import threading
+import time
+
+LOG = logging.getLogger('owen.metrics')
+# Stay quiet unless the application configures logging
+LOG.addHandler(logging.NullHandler())
+
+# Upper bounds in seconds of the step duration histogram buckets
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    pairs = ('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+             for k, v in labels)
+    return '{%s}' % ','.join(pairs)
+
+
+class Registry(object):
+    """Thread-safe store of counters, histograms and gauges.
+
+    Counters and histograms are keyed by metric name and a sorted
+    tuple of label pairs. Gauges are callables read at render time.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(BUCKETS), 0, 0.0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += 1
+            hist[2] += value
+
+    def reset(self):
+        """Forget everything recorded, with a new lock.
+
+        For a forked child process: another thread of the parent may
+        have been holding the old lock.
+        """
+        self._lock = threading.Lock()
+        self._counters, self._histograms = {}, {}
+
+    def drain(self):
+        "Counters and histograms recorded since the last drain"
+        with self._lock:
+            data = (self._counters, self._histograms)
+            self._counters, self._histograms = {}, {}
+        return data
+
+    def merge(self, data):
+        "Add counters and histograms returned by another registry's drain"
+        counters, histograms = data
+        with self._lock:
+            for key, value in counters.iteritems():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, (buckets, count, total) in histograms.iteritems():
+                hist = self._histograms.get(key)
+                if hist is None:
+                    hist = self._histograms[key] = [[0] * len(BUCKETS),
+                                                    0, 0.0]
+                hist[0] = [a + b for a, b in zip(hist[0], buckets)]
+                hist[1] += count
+                hist[2] += total
+
+    def gauge(self, name, func, text=None):
+        """Report the value of func() as gauge `name`."""
+        self._gauges[name] = func
+        if text:
+            self.describe(name, 'gauge', text)
+
+    def _header(self, lines, name, kind):
+        help_kind, text = self._help.get(name, (kind, None))
+        if text:
+            lines.append('# HELP %s %s' % (name, text))
+        lines.append('# TYPE %s %s' % (name, help_kind))
+
+    def render(self):
+        "Every metric in the Prometheus text exposition format"
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, (list(h[0]), h[1], h[2]))
+                                for k, h in self._histograms.items())
+        lines = []
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                self._header(lines, name, 'counter')
+                seen.add(name)
+            lines.append('%s%s %s' % (name, _labels(labels), value))
+        for (name, labels), (buckets, count, total) in histograms:
+            if name not in seen:
+                self._header(lines, name, 'histogram')
+                seen.add(name)
+            for bound, n in zip(BUCKETS, buckets):
+                lines.append('%s_bucket%s %d' % (
+                    name, _labels(labels + (('le', bound),)), n))
+            lines.append('%s_bucket%s %d' % (
+                name, _labels(labels + (('le', '+Inf'),)), count))
+            lines.append('%s_sum%s %f' % (name, _labels(labels), total))
+            lines.append('%s_count%s %d' % (name, _labels(labels), count))
+        for name, func in sorted(self._gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                LOG.exception("Failed to read gauge %s", name)
+                continue
+            self._header(lines, name, 'gauge')
+            lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+REGISTRY.describe('owen_step_seconds', 'histogram',
+                  'Time spent in each step of an ESC workflow')
+REGISTRY.describe('owen_steps_total', 'counter',
+                  'ESC workflow steps run, by step and outcome')
+
+
+def log_event(event, **fields):
+    """Write one structured (JSON) log line."""
+    fields['event'] = event
+    LOG.info(json.dumps(fields, sort_keys=True, default=str))
+
+
+@contextlib.contextmanager
+def span(step, registry=REGISTRY, **fields):
+    """Time the enclosed block as workflow step `step`.
+
+    The duration goes to the owen_step_seconds histogram and the
+    outcome, ok or error, to the owen_steps_total counter; both are
+    labelled by step. A structured log line is written either way.
+    Extra keyword arguments are only added to the log line.
+    """
+    start = time.time()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        elapsed = time.time() - start
+        registry.observe('owen_step_seconds', elapsed, step=step)
+        registry.inc('owen_steps_total', step=step, outcome=outcome)
+        log_event('step', step=step, outcome=outcome,
+                  seconds=round(elapsed, 3), **fields)
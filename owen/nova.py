@@ -0,0 +1,35 @@
+""" owen.nova - read compute node inventory from OpenStack Nova. """
+
+PAGE_SIZE = 500
+
+
+def client(config, section='nova'):
+    """Nova client built from the [nova] section of the config file."""
+    from novaclient import client as nova_client
+    return nova_client.Client(config.get(section, 'version'),
+                              config.get(section, 'username'),
+                              config.get(section, 'password'),
+                              config.get(section, 'tenant'),
+                              config.get(section, 'auth_url'))
+
+
+def hypervisor_hostnames(nova, page_size=PAGE_SIZE):
+    """Yield the hostname of every hypervisor, a page at a time.
+
+    Falls back to a single listing for clients and APIs that predate
+    hypervisor paging.
+    """
+    marker = None
+    while True:
+        try:
+            page = nova.hypervisors.list(detailed=False, marker=marker,
+                                         limit=page_size)
+        except TypeError:
+            # Client predates paging, everything comes back at once
+            page = nova.hypervisors.list(detailed=False)
+            page_size = len(page) + 1
+        for hypervisor in page:
+            yield hypervisor.hypervisor_hostname
+        if len(page) < page_size:
+            return
+        marker = page[-1].id
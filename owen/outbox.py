@@ -0,0 +1,228 @@
+""" owen.outbox - durable queue of ticket submissions. """
+import itertools
+import time
+from datetime import datetime
+
+import sqlalchemy
+from sqlalchemy.orm import joinedload, joinedload_all
+
+from owen import jobs
+from owen.db import models
+
+
+# Entries are held once they have been sent this many times
+MAX_ATTEMPTS = 5
+
+
+def unsendable(machine):
+    "Why the server would reject tickets for machine, or None"
+    for field, name in [('machine_type', 'machine type'),
+                        ('serial', 'serial')]:
+        if not getattr(machine, field):
+            return "machine %s has no %s" % (machine.hostname, name)
+    return None
+
+
+def enqueue(session, part_requests):
+    """Queue part requests for submission in the session's transaction.
+
+    Part requests the server would reject are left out and returned.
+    """
+    rejected = [pr for pr in part_requests if unsendable(pr.machine)]
+    session.add_all([models.OutboxEntry(part_request=pr)
+                     for pr in part_requests if pr not in rejected])
+    return rejected
+
+
+def _outcome(result, error):
+    """(problem number, error, resend) for a call's result. The error
+    is None for calls ESC accepted. Failed calls are only resent when
+    the server says they never reached ESC."""
+    if result.get('status') == jobs.SUCCEEDED:
+        return (result.get('problem_number'), None, False)
+    return (None, result.get('error') or error,
+            result.get('submitted') is False)
+
+
+def _outcomes(job, count):
+    "_outcome for each of the `count` tickets of a finished job"
+    if 'results' not in job or job.get('status') != jobs.SUCCEEDED:
+        return [_outcome(job, 'Submission job failed')] * count
+    return [_outcome(r, 'Call failed') for r in job['results']]
+
+
+def _hold(entry, error):
+    entry.held = True
+    entry.last_error = error
+
+
+def _retry(entry, error, max_attempts):
+    "Queue entry to be sent again, or hold it if it was sent too often"
+    entry.job_id = None
+    if entry.attempts >= max_attempts:
+        _hold(entry, "%s (gave up after %d attempts)" % (error,
+                                                         entry.attempts))
+        return False
+    entry.last_error = error
+    return True
+
+
+def _client_error(result):
+    return result.status_code is not None and \
+        400 <= result.status_code < 500 and result.status_code != 429
+
+
+def poll(session, submitter, max_attempts=MAX_ATTEMPTS):
+    """Check the jobs of submissions the server accepted, and commit.
+
+    Entries whose call was placed are marked delivered and their
+    PartRequest gets the problem number as its ticket number. Entries
+    whose call failed before reaching ESC lose their job id so they
+    are sent again, unless they were sent `max_attempts` times. Those
+    that may have reached it, or whose job the server no longer knows,
+    are held for an operator to check, since sending them again could
+    open a second call.
+
+    Returns (delivered, failed, held), where held lists the entries
+    held by this poll.
+    """
+    Entry = models.OutboxEntry
+    entries = session.query(Entry).\
+        options(joinedload('part_request')).\
+        filter(sqlalchemy.not_(Entry.delivered)).\
+        filter(sqlalchemy.not_(Entry.held)).\
+        filter(Entry.job_id != None).\
+        order_by(Entry.job_id, Entry.id).all()
+    delivered = failed = 0
+    held = []
+    for job_id, group in itertools.groupby(entries, lambda e: e.job_id):
+        group = list(group)
+        result = submitter.job_status(job_id,
+                                      [e.part_request for e in group])
+        if result.ok:
+            if result.job.get('status') in (jobs.QUEUED, jobs.RUNNING):
+                continue
+            outcomes = _outcomes(result.job, len(group))
+        elif result.status_code == 404:
+            outcomes = [(None, "Job %s unknown to the server" % job_id,
+                         False)] * len(group)
+        else:
+            # Server unreachable, ask again next time
+            for entry in group:
+                entry.last_error = result.error
+            continue
+        now = datetime.now()
+        # A batch job's results are in the order its entries were sent
+        for entry, (number, error, resend) in zip(group, outcomes):
+            if error is None:
+                entry.delivered = True
+                entry.date_delivered = now
+                entry.last_error = None
+                if number:
+                    entry.part_request.ticket_number = number
+                delivered += 1
+            elif not resend:
+                _hold(entry, error)
+                held.append(entry)
+            elif _retry(entry, error, max_attempts):
+                failed += 1
+            else:
+                held.append(entry)
+    session.commit()
+    return (delivered, failed, held)
+
+
+def send(session, submitter, batch_size=50, each=False,
+         max_attempts=MAX_ATTEMPTS):
+    """Send queued submissions, committing after every batch.
+
+    Each batch goes to the server as one batch request, or with `each`
+    as one request per ticket. A batch the server refuses is sent
+    again one request per ticket, so that one bad ticket does not hold
+    up the others. Every entry records the attempt; those the server
+    accepted keep the id of the job placing their call. Entries that
+    failed `max_attempts` times are held.
+
+    Returns (sent, failed, held), where held lists the entries held.
+    """
+    Entry = models.OutboxEntry
+    sent = failed = 0
+    held = []
+    last_id = 0
+    while True:
+        entries = session.query(Entry).\
+            options(joinedload_all('part_request.machine'),
+                    joinedload_all('part_request.part')).\
+            filter(sqlalchemy.not_(Entry.delivered)).\
+            filter(sqlalchemy.not_(Entry.held)).\
+            filter(Entry.job_id == None).\
+            filter(Entry.id > last_id).\
+            order_by(Entry.id).limit(batch_size).all()
+        if not entries:
+            break
+        last_id = entries[-1].id
+        part_requests = [entry.part_request for entry in entries]
+        keys = [entry.idempotency_key for entry in entries]
+        if each:
+            results = submitter.submit_each(part_requests, keys)
+        else:
+            result = submitter.submit_tickets(part_requests, keys)
+            if _client_error(result) and len(entries) > 1:
+                results = submitter.submit_each(part_requests, keys)
+            else:
+                results = [result] * len(entries)
+        now = datetime.now()
+        for entry, result in zip(entries, results):
+            entry.attempts = (entry.attempts or 0) + 1
+            entry.date_attempted = now
+            if result.ok:
+                entry.job_id = result.job.get('id')
+                entry.last_error = None
+                sent += 1
+            elif _retry(entry, result.error, max_attempts):
+                failed += 1
+            else:
+                held.append(entry)
+        session.commit()
+    return (sent, failed, held)
+
+
+def flush(session, submitter, batch_size=50, each=False,
+          max_attempts=MAX_ATTEMPTS):
+    """Collect the outcome of earlier submissions, then send the queued
+    ones. Returns (sent, delivered, failed, held) as poll and send do."""
+    delivered, failed, held = poll(session, submitter,
+                                   max_attempts=max_attempts)
+    sent, unsent, unsendable = send(session, submitter,
+                                    batch_size=batch_size, each=each,
+                                    max_attempts=max_attempts)
+    return (sent, delivered, failed + unsent, held + unsendable)
+
+
+def _held(session, part_request_ids):
+    Entry = models.OutboxEntry
+    return session.query(Entry).\
+        filter(Entry.part_request_id.in_(part_request_ids)).\
+        filter(Entry.held == True)
+
+
+def requeue(session, part_request_ids):
+    """Send the held submissions of these tickets again, in the
+    session's transaction. Returns how many there were."""
+    return _held(session, part_request_ids).update(
+        {'held': False, 'job_id': None, 'attempts': 0},
+        synchronize_session=False)
+
+
+def settle(session, part_request_ids):
+    """Mark the held submissions of these tickets delivered, for calls
+    found in ESC by hand. Returns how many there were."""
+    return _held(session, part_request_ids).update(
+        {'held': False, 'delivered': True, 'date_delivered': datetime.now()},
+        synchronize_session=False)
+
+
+def flush_forever(session, submitter, interval, **kwargs):
+    while True:
+        yield flush(session, submitter, **kwargs)
+        time.sleep(interval)
@@ -1,12 +1,25 @@
 """ server.py - Selenium Submission Server . """
 import ConfigParser
 import flask
+import hashlib
+import logging
 import os
 import re
+import signal
 import sys
-import time
+import threading
 
-from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.support.ui import WebDriverWait
+
+from owen import browser
+from owen.browser import SessionPool
+from owen.driver import esc
+from owen.driver.forms import fill_form
+from owen.driver import sessions
+from owen import jobs
+from owen import metrics
+from owen import workers
 
 try:
     import OpenSSL
@@ -15,97 +28,301 @@ except ImportError:
     _has_ssl = False
 
 
-def fill_form(driver, data):
-    for id, text in data.iteritems():
-        if text is None:
-            text = ''
-        el = driver.find_element_by_id(id)
-        if not el:
-            return
-        el.send_keys(text)
+def handle_after_hours_popup(driver, form_win, timeout):
+    # Find the popup window
+    maybe_popup_windows = [w for w in driver.window_handles if w != form_win]
+    for window in maybe_popup_windows:
+        driver.switch_to_window(window)
+        try:
+            service_tomorrow = WebDriverWait(driver, timeout).until(
+                lambda d: d.find_element_by_id("Status_TypeA"))
+        except TimeoutException:
+            continue
+        service_tomorrow.click()
+        driver.find_element_by_name("ibm-submit").click()
+        break
+    driver.switch_to_window(form_win)
 
 
-def handle_after_hours_popup(driver, form_win):
-    # Find the popup window
-    done = False
-    tries = 0
-    while not done and tries < 2:
-        maybe_popup_windows = [w for w in driver.window_handles if
-                               w != form_win]
-        for window in maybe_popup_windows:
-            driver.switch_to_window(window)
-            try:
-                service_tomorrow = driver.find_element_by_id("Status_TypeA")
-                service_tomorrow.click()
-                driver.find_element_by_name("ibm-submit").click()
-                done = True
-            except Exception:
-                pass
-            if done:
-                break
-        time.sleep(1)
-        tries += 1
+def _submit_outcome(driver, popup_handled):
+    """Return what ESC showed after the form was submitted, if anything."""
+    if not popup_handled and len(driver.window_handles) > 1:
+        return 'popup'
+    source = driver.page_source
+    if esc.find_problem_number(source):
+        return 'confirmation'
+    if driver.find_elements_by_css_selector(esc.ERROR_SELECTOR):
+        return 'error'
+    return None
+
+
+def wait_for_confirmation(driver, form_win, timeouts):
+    """Wait for ESC to confirm the call and return its problem number."""
+    popup_handled = False
+    while True:
+        outcome = WebDriverWait(driver, timeouts['submit']).until(
+            lambda d: _submit_outcome(d, popup_handled))
+        if outcome != 'popup':
+            break
+        # There may be a popup for after-hours stuff
+        with metrics.span('popup'):
+            handle_after_hours_popup(driver, form_win, timeouts['popup'])
+        popup_handled = True
+    if outcome == 'error':
+        banner = driver.find_elements_by_css_selector(esc.ERROR_SELECTOR)
+        raise esc.ESCError("ESC rejected the call: %s" % banner[0].text)
+    return esc.find_problem_number(driver.page_source)
+
+
+class CallError(Exception):
+    """A call that failed. Its `details` say whether the form was
+    submitted, after which ESC may have opened the call anyway."""
+    def __init__(self, error, submitted):
+        Exception.__init__(self, str(error) or error.__class__.__name__)
+        self.details = {'submitted': submitted}
 
 app = flask.Flask(__name__)
 defaults = {'host': '127.0.0.1',
             'port': 8080,
             'private-key-file': None,
-            'certificate-file': None}
+            'certificate-file': None,
+            'size': '2',
+            'idle-timeout': '600',
+            'max-uses': '25',
+            'session-dir': sessions.DEFAULT_PATH,
+            'headless': 'true',
+            'images': 'false',
+            'stylesheets': 'true',
+            'page-load-strategy': 'eager',
+            'page-load-timeout': '60',
+            'script-timeout': '30',
+            'workers': '2',
+            'retention': '3600',
+            'dedupe-window': '3600',
+            'submit': '60',
+            'popup': '5',
+            'mode': 'development',
+            'processes': '2',
+            'shutdown-timeout': '300',
+            'call-timeout': '900'}
 
 
-@app.route('/', methods=['POST'])
-def submit_ticket():
-    if flask.request.mimetype not in _json_mimes:
-        flask.abort(400)
-    data = flask.request.get_json(silent=True)
-    if data.get('secret', '') != flask.current_app.secret:
-        flask.abort(403)
+def parse_ticket(data):
+    """Split a ticket request body into login and submit form data.
+
+    Aborts with 400 Bad Request unless every required field is given.
+    """
     login_form_keys = ['j_username', 'j_password']
     submit_form_keys = ["Customer_Name", "CustPhoneNumber", "Street",
                         "City", "State", "Zip", "Contact_Location",
                         "ContactName", "ContPhoneNumber", "Product",
-                        "Model", "Serial_Number", "Comments"]
+                        "Serial_Number", "Comments"]
     submit_form_optional = ["Part_Number", "Model"]
-    login_form, submit_form = ({}, {})
-    try:
-        for key in login_form_keys:
-            login_form[key] = data.get(key)
-        for key in submit_form_keys:
-            submit_form[key] = data.get(key)
-    except KeyError:
+    if not isinstance(data, dict):
         flask.abort(400)
-    for key in submit_form_optional:
-        try:
-            submit_form[key] = data.get(key)
-        except KeyError:
-            pass
+    if any(data.get(key) is None for key in
+           login_form_keys + submit_form_keys):
+        flask.abort(400)
+    if not isinstance(data['Product'], basestring):
+        flask.abort(400)
+    login_form = dict((key, data[key]) for key in login_form_keys)
+    submit_form = dict((key, data.get(key)) for key in
+                       submit_form_keys + submit_form_optional)
 
     product = submit_form['Product']
     if re.match(".*AC1$",  product):
         submit_form['Product'] = product[:len(product)-3]
     if not submit_form['Model']:
         submit_form['Model'] = 'AC1'
+    return login_form, submit_form
 
-    # Get driver, login and fill out form
-    driver = webdriver.Firefox()
-    driver.get("https://www-930.ibm.com/support/esc/signin.jsp")
-    fill_form(driver, login_form)
-    driver.find_element_by_name('ibm-submit').click()
-    driver.get("https://www-930.ibm.com/support/esc/placecall_upr.jsp")
-    fill_form(driver, submit_form)
-    # Before we submit, capture the current window handle
-    form_window = driver.current_window_handle
-    # Click submit button
-    elem = driver.find_element_by_name("ibm-submit")
-    elem.click()
-    # There may be a popup for after-hours stuff
-    handle_after_hours_popup(driver, form_window)
-    time.sleep(8)
-    driver.quit()
-    response = flask.Response(None, status=200, mimetype='text/plain')
+
+def _place_call(session, submit_form, timeouts):
+    driver = session.driver
+    with metrics.span('place_call', serial=submit_form['Serial_Number']):
+        with metrics.span('load_form'):
+            session.get(esc.ESC_URL + esc.PLACECALL_PAGE)
+        with metrics.span('fill_form'):
+            fill_form(driver, submit_form)
+        # Before we submit, capture the current window handle
+        form_window = driver.current_window_handle
+        button = driver.find_element_by_name("ibm-submit")
+        try:
+            # Click submit button
+            with metrics.span('submit'):
+                button.click()
+            with metrics.span('confirmation'):
+                problem_number = wait_for_confirmation(driver, form_window,
+                                                       timeouts)
+        except Exception as e:
+            raise CallError(e, submitted=True)
+    return {'problem_number': problem_number, 'submitted': True}
+
+
+def place_call(pool, login_form, submit_form, timeouts):
+    """Submit one ticket to ESC, returning a dict describing the result.
+
+    Raises CallError if the call was not confirmed.
+    """
+    try:
+        # Get a logged-in driver from the pool and fill out form
+        with pool.session(login_form) as session:
+            return _place_call(session, submit_form, timeouts)
+    except CallError:
+        raise
+    except Exception as e:
+        raise CallError(e, submitted=False)
+
+
+def place_calls(pool, login_form, submit_forms, timeouts):
+    """Submit several tickets to ESC in sequence over one login.
+
+    Returns a result for every ticket, with `submitted` telling failed
+    calls whose form was submitted from those that never reached ESC.
+    If the browser cannot be logged in, or is lost after a failed call,
+    the tickets not yet tried are reported failed with that error.
+    """
+    results = []
+    try:
+        with pool.session(login_form) as session:
+            for submit_form in submit_forms:
+                try:
+                    result = _place_call(session, submit_form, timeouts)
+                    result['status'] = jobs.SUCCEEDED
+                except CallError as e:
+                    result = {'status': jobs.FAILED, 'error': str(e)}
+                    result.update(e.details)
+                except Exception as e:
+                    result = {'status': jobs.FAILED,
+                              'error': str(e) or e.__class__.__name__,
+                              'submitted': False}
+                result['Serial_Number'] = submit_form['Serial_Number']
+                results.append(result)
+                workers.report(result)
+                if result['status'] == jobs.FAILED:
+                    # Raises if the browser is gone, so the pool drops it
+                    session.reset()
+    except Exception as e:
+        error = "ESC session failed: %s" % (str(e) or e.__class__.__name__)
+        for submit_form in submit_forms[len(results):]:
+            results.append({'status': jobs.FAILED, 'error': error,
+                            'submitted': False,
+                            'Serial_Number': submit_form['Serial_Number']})
+    return {'results': results}
+
+
+def run_batch(runner, login_form, submit_forms):
+    """Run place_calls with runner.
+
+    If the worker is lost, the results it reported are kept. The call
+    it was placing failed but may have been submitted; the rest were
+    never tried.
+    """
+    try:
+        return runner.call(place_calls, login_form, submit_forms)
+    except workers.WorkerError as e:
+        results = e.progress
+        error = str(e)
+        for i, submit_form in enumerate(submit_forms[len(results):]):
+            result = {'status': jobs.FAILED, 'error': error,
+                      'Serial_Number': submit_form['Serial_Number']}
+            if i > 0:
+                result['submitted'] = False
+            results.append(result)
+        return {'results': results}
+
+
+@app.route('/', methods=['POST'])
+def submit_ticket():
+    if flask.request.mimetype not in _json_mimes:
+        flask.abort(400)
+    data = flask.request.get_json(silent=True)
+    if not isinstance(data, dict):
+        flask.abort(400)
+    if data.get('secret', '') != flask.current_app.secret:
+        flask.abort(403)
+    login_form, submit_form = parse_ticket(data)
+    key = _request_key(data) or _ticket_key(submit_form)
+    runner = flask.current_app.runner
+    job = flask.current_app.jobs.submit_keyed(key, runner.call, place_call,
+                                              login_form, submit_form)
+    return _accepted(job)
+
+
+@app.route('/batch', methods=['POST'])
+def submit_batch():
+    if flask.request.mimetype not in _json_mimes:
+        flask.abort(400)
+    data = flask.request.get_json(silent=True)
+    if not isinstance(data, dict):
+        flask.abort(400)
+    if data.get('secret', '') != flask.current_app.secret:
+        flask.abort(403)
+    tickets = data.get('tickets')
+    if not tickets or not isinstance(tickets, list):
+        flask.abort(400)
+    login_form = None
+    submit_forms = []
+    for ticket in tickets:
+        if not isinstance(ticket, dict):
+            flask.abort(400)
+        ticket_login, submit_form = parse_ticket(ticket)
+        if login_form is None:
+            login_form = ticket_login
+        elif ticket_login != login_form:
+            # Every ticket in a batch goes through the same ESC login
+            flask.abort(400)
+        submit_forms.append(submit_form)
+    key = _request_key(data)
+    if key is None:
+        key = hashlib.sha1(':'.join(_ticket_key(form)
+                                    for form in submit_forms)).hexdigest()
+    # Keep batch keys apart from single ticket keys
+    key = 'batch:' + key
+    runner = flask.current_app.runner
+    job = flask.current_app.jobs.submit_keyed(key, run_batch, runner,
+                                              login_form, submit_forms)
+    return _accepted(job)
+
+
+def _request_key(data):
+    """Idempotency key given by the client, if any."""
+    return (flask.request.headers.get('Idempotency-Key') or
+            data.get('idempotency_key'))
+
+
+def _ticket_key(submit_form):
+    """Idempotency key for a ticket that came without one."""
+    fields = [submit_form.get('Serial_Number'),
+              submit_form.get('Part_Number'),
+              submit_form.get('Comments')]
+    text = u'\0'.join(f or u'' for f in fields)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _accepted(job):
+    metrics.log_event('accepted', job=job.id, status=job.status,
+                      queue_depth=flask.current_app.jobs.depth())
+    response = flask.jsonify(job.to_dict())
+    response.status_code = 202
+    response.headers['Location'] = flask.url_for('job_status', job_id=job.id)
     return response
 
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = flask.current_app.jobs.get(job_id)
+    if job is None:
+        flask.abort(404)
+    return flask.jsonify(job.to_dict())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_text():
+    return flask.Response(metrics.REGISTRY.render(),
+                          mimetype='text/plain; version=0.0.4')
+
+
 def main():
     usage = '%s owen.config' % sys.argv[0]
     if len(sys.argv) != 2:
@@ -126,11 +343,86 @@ def main():
         ssl_context = OpenSSL.SSL.Context(OpenSSL.SSL.SSLv23_METHOD)
         ssl_context.use_privatekey_file(private_key_file)
         ssl_context.use_certificate_file(certificate_file)
+    # How long to wait on ESC pages
+    if not config.has_section('timeouts'):
+        config.add_section('timeouts')
+    timeouts = {'submit': config.getint('timeouts', 'submit'),
+                'popup': config.getint('timeouts', 'popup')}
+    # Browser pool configuration
+    if not config.has_section('pool'):
+        config.add_section('pool')
+    pool_options = {'size': config.getint('pool', 'size'),
+                    'idle_timeout': config.getint('pool', 'idle-timeout'),
+                    'max_uses': config.getint('pool', 'max-uses'),
+                    'store': sessions.from_config(config, 'pool',
+                                                  'session-dir'),
+                    'browser': browser.from_config(config)}
+    # Serving mode
+    if not config.has_section('server'):
+        config.add_section('server')
+    mode = config.get('server', 'mode')
+    if mode not in ('development', 'production'):
+        print >> sys.stderr, "Unknown server mode: %s" % mode
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)s %(message)s')
+    # Submission queue configuration
+    if not config.has_section('jobs'):
+        config.add_section('jobs')
+    if mode == 'production':
+        # Each worker process owns one browser; fork them before any
+        # threads are started here. Replacements forked later reset
+        # the locks they inherit.
+        job_workers = config.getint('server', 'processes')
+        pool_options['size'] = 1
+        runner = workers.WorkerPool(
+            job_workers, pool_options, timeouts,
+            call_timeout=config.getint('server', 'call-timeout'))
+    else:
+        job_workers = config.getint('jobs', 'workers')
+        runner = workers.LocalRunner(SessionPool(**pool_options), timeouts)
+    job_queue = jobs.JobQueue(
+        workers=job_workers,
+        retention=config.getint('jobs', 'retention'),
+        dedupe_window=config.getint('jobs', 'dedupe-window'))
+    metrics.REGISTRY.gauge('owen_queue_depth', job_queue.depth,
+                           'Submissions waiting for a free worker')
     with app.app_context():
         flask.current_app.secret = config.get('default', 'secret')
+        flask.current_app.runner = runner
+        flask.current_app.jobs = job_queue
     host = config.get('default', 'host')
     port = config.getint('default', 'port')
-    app.run(host=host, port=port,  debug=True, ssl_context=ssl_context)
+    if mode == 'production':
+        serve(host, port, ssl_context, job_queue, runner,
+              config.getint('server', 'shutdown-timeout'))
+    else:
+        app.run(host=host, port=port,  debug=True, ssl_context=ssl_context)
+
+
+def serve(host, port, ssl_context, job_queue, runner, shutdown_timeout):
+    """Serve requests until SIGTERM or SIGINT, then shut down gracefully.
+
+    New connections stop being accepted, accepted submissions get up
+    to `shutdown_timeout` seconds to finish, and then the workers stop.
+    """
+    from werkzeug.serving import make_server
+    log = logging.getLogger(__name__)
+    server = make_server(host, port, app, threaded=True,
+                         ssl_context=ssl_context)
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever(), so not from this thread
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    log.info("Serving on %s:%d", host, port)
+    server.serve_forever()
+    log.info("Shutting down with %d submissions queued", job_queue.depth())
+    if not job_queue.join(shutdown_timeout):
+        log.warning("Submissions still running after %d seconds",
+                    shutdown_timeout)
+    runner.close(timeout=shutdown_timeout)
 
 _json_mimes = ['application/json']
 
@@ -0,0 +1,87 @@
+""" owen.sync - keep PartRequest status in step with ESC. """
+import hashlib
+import time
+from datetime import datetime
+
+import sqlalchemy
+
+from owen.db import models
+from owen.driver import esc
+
+
+class StatusSync(object):
+    """Copy the status of ESC calls onto matching PartRequest rows.
+
+    Requests are matched to calls by ticket number. A call's detail
+    page is hashed and only requests whose hash changed are written,
+    all in one executemany UPDATE. Closed requests are only looked at
+    if they were closed after the previous run (the watermark).
+    """
+    name = 'esc-status'
+
+    def __init__(self, session, driver, concurrency=2):
+        self.session = session
+        self.driver = driver
+        self.concurrency = concurrency
+
+    def _watermark(self):
+        state = self.session.query(models.SyncState).get(self.name)
+        if state is None:
+            state = models.SyncState(name=self.name)
+            self.session.add(state)
+        return state
+
+    def _candidates(self, numbers, since):
+        PR = models.PartRequest
+        q = self.session.query(PR.id, PR.ticket_number, PR.status,
+                               PR.detail_hash).\
+            filter(PR.ticket_number.in_(numbers))
+        if since is not None:
+            q = q.filter(sqlalchemy.or_(sqlalchemy.not_(PR.closed),
+                                        PR.date_closed >= since))
+        return q.all()
+
+    def run_once(self):
+        """Run one sync cycle, returning (checked, updated, failed)."""
+        started = datetime.now()
+        state = self._watermark()
+        self.driver.refresh()
+        call_ids = dict((num, id) for id, num in self.driver.calls.calls())
+        rows = []
+        if call_ids:
+            rows = self._candidates(call_ids.keys(), state.last_run)
+        by_call = dict((call_ids[row.ticket_number], row) for row in rows)
+        updates = []
+        failed = 0
+        for result in self.driver.fetch_details(by_call.keys(),
+                                                concurrency=self.concurrency):
+            if result.error is not None:
+                failed += 1
+                continue
+            row = by_call[result.call_id]
+            details = result.details
+            if isinstance(details, unicode):
+                details = details.encode('utf-8')
+            digest = hashlib.sha1(details).hexdigest()
+            if digest == row.detail_hash:
+                continue
+            status = esc.find_status(result.details) or row.status
+            updates.append({'_id': row.id, '_status': status,
+                            '_hash': digest})
+        if updates:
+            table = models.PartRequest.__table__
+            stmt = table.update().\
+                where(table.c.id == sqlalchemy.bindparam('_id')).\
+                values(status=sqlalchemy.bindparam('_status'),
+                       detail_hash=sqlalchemy.bindparam('_hash'))
+            self.session.execute(stmt, updates)
+        # Only move the watermark if every call was checked
+        if not failed:
+            state.last_run = started
+        self.session.commit()
+        return (len(rows), len(updates), failed)
+
+    def run_forever(self, interval):
+        while True:
+            yield self.run_once()
+            time.sleep(interval)
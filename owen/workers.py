@@ -0,0 +1,217 @@
+""" owen.workers - run ESC submissions in browser-owning processes. """
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from owen.browser import SessionPool
+from owen import metrics
+
+LOG = logging.getLogger(__name__)
+
+metrics.REGISTRY.describe('owen_worker_restarts_total', 'counter',
+                          'Worker processes restarted after dying')
+
+
+class WorkerError(Exception):
+    """A call that failed in its worker, or with it. `details` are
+    those of the worker's exception, if it had any, and `progress` what
+    the call reported before it failed."""
+    def __init__(self, message, details=None, progress=()):
+        Exception.__init__(self, message)
+        self.details = details
+        self.progress = list(progress)
+
+
+# Set in a worker process to send what its call reports to the parent
+_progress = None
+
+
+def report(item):
+    """Report item as progress of the call running in this worker
+    process, which keeps it if the worker is lost later. Does nothing
+    outside a worker process."""
+    if _progress is not None:
+        _progress(item)
+
+
+class LocalRunner(object):
+    """Runs submissions in the calling thread with a shared SessionPool."""
+    def __init__(self, pool, timeouts):
+        self.pool = pool
+        self.timeouts = timeouts
+
+    def call(self, func, *args):
+        return func(self.pool, *(args + (self.timeouts,)))
+
+    def close(self, timeout=None):
+        self.pool.close()
+
+
+def _after_fork():
+    """Replace the locks the parent's other threads may have held when
+    this process was forked, which nothing here would ever release."""
+    metrics.REGISTRY.reset()
+    logging._lock = threading.RLock()
+    for ref in logging._handlerList:
+        handler = ref()
+        if handler is not None:
+            handler.createLock()
+
+
+def _worker_main(conn, pool_options, timeouts):
+    global _progress
+    _after_fork()
+    _progress = lambda item: conn.send(('progress', item,
+                                        metrics.REGISTRY.drain()))
+    # The parent decides when we stop, after our current submission
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    pool = SessionPool(**pool_options)
+    try:
+        while True:
+            try:
+                task = conn.recv()
+            except EOFError:
+                break
+            if task is None:
+                break
+            func, args = task
+            try:
+                reply = ('ok', func(pool, *(args + (timeouts,))))
+            except Exception as e:
+                LOG.exception("Submission failed in worker %d", os.getpid())
+                reply = ('error', (str(e) or e.__class__.__name__,
+                                   getattr(e, 'details', None)))
+            conn.send(reply + (metrics.REGISTRY.drain(),))
+    finally:
+        pool.close()
+
+
+class WorkerPool(object):
+    """Fixed number of worker processes, each with its own browser.
+
+    call() hands a submission function and its arguments to an idle
+    worker over that worker's pipe and blocks until it replies; the
+    function is called with the worker's SessionPool first and the
+    timeouts last, like LocalRunner does. A worker that dies, or that
+    has neither replied nor reported progress for `call_timeout`
+    seconds and is killed, is replaced and the call it was running
+    fails with a WorkerError holding the progress it reported. Step
+    metrics recorded in the workers are merged into this process's
+    registry.
+    """
+    def __init__(self, processes, pool_options, timeouts, call_timeout=None):
+        self.processes = processes
+        self.pool_options = pool_options
+        self.timeouts = timeouts
+        self.call_timeout = call_timeout
+        self._cond = threading.Condition()
+        self._workers = []
+        self._idle = []
+        self._closing = False
+        for i in range(processes):
+            self._start_worker()
+
+    def _start_worker(self):
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_worker_main,
+            args=(child_conn, self.pool_options, self.timeouts))
+        process.daemon = True
+        process.start()
+        # Only the child keeps its end, so we see EOF if it dies
+        child_conn.close()
+        worker = (process, conn)
+        self._workers.append(worker)
+        self._idle.append(worker)
+        LOG.info("Started worker process %d", process.pid)
+
+    def _replace(self, worker):
+        "Reap a dead worker and, unless shutting down, start another"
+        process, conn = worker
+        process.join()
+        conn.close()
+        LOG.warning("Worker process %d exited with %s", process.pid,
+                    process.exitcode)
+        with self._cond:
+            self._workers.remove(worker)
+            if not self._closing:
+                metrics.REGISTRY.inc('owen_worker_restarts_total')
+                self._start_worker()
+            self._cond.notify_all()
+
+    def _checkout(self):
+        while True:
+            with self._cond:
+                while not self._idle and not self._closing:
+                    self._cond.wait()
+                if self._closing:
+                    raise WorkerError("Worker pool is shutting down")
+                worker = self._idle.pop()
+            if worker[0].is_alive():
+                return worker
+            self._replace(worker)
+
+    def call(self, func, *args):
+        worker = self._checkout()
+        process, conn = worker
+        progress = []
+        try:
+            conn.send((func, args))
+            while True:
+                # A dead worker's pipe polls as readable and recv() fails
+                if not conn.poll(self.call_timeout):
+                    LOG.warning("Killing worker process %d, no reply after "
+                                "%s seconds", process.pid, self.call_timeout)
+                    os.kill(process.pid, signal.SIGKILL)
+                    self._replace(worker)
+                    raise WorkerError("Worker process %d timed out"
+                                      % process.pid, progress=progress)
+                status, value, stats = conn.recv()
+                metrics.REGISTRY.merge(stats)
+                if status != 'progress':
+                    break
+                progress.append(value)
+        except (EOFError, IOError, OSError):
+            self._replace(worker)
+            raise WorkerError("Worker process %d died" % process.pid,
+                              progress=progress)
+        with self._cond:
+            self._idle.append(worker)
+            self._cond.notify_all()
+        if status == 'error':
+            raise WorkerError(*value)
+        return value
+
+    def close(self, timeout=None):
+        """Stop the workers once their current submissions are done.
+
+        Workers still busy after `timeout` seconds are killed.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+            while len(self._idle) < len(self._workers):
+                if deadline is None:
+                    self._cond.wait()
+                elif deadline <= time.time():
+                    break
+                else:
+                    self._cond.wait(deadline - time.time())
+            workers = list(self._workers)
+            idle = list(self._idle)
+        for process, conn in idle:
+            conn.send(None)
+        for process, conn in workers:
+            if deadline is None:
+                process.join()
+            else:
+                process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                LOG.warning("Killing worker process %d", process.pid)
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
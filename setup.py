@@ -15,8 +15,11 @@ setup(
     url='https://github.com/devoid/owen',
     license='LICENSE.txt',
     long_description=open(cwd + '/README.txt').read(),
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests']),
+    package_data={'owen.db': ['migrations/*.py', 'migrations/*.mako',
+                              'migrations/versions/*.py']},
     install_requires=required,
+    test_suite='tests',
     entry_points={
         'console_scripts' : [
               'ibm-service = owen.cmd.ibm_service:main',
@@ -0,0 +1,131 @@
+""" Tests for loading machines from the Nova hypervisor list. """
+import unittest
+
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+
+from owen import nova
+from owen.db import bulk
+from owen.db import models
+
+
+class Hypervisor(object):
+    def __init__(self, id, hostname):
+        self.id = id
+        self.hypervisor_hostname = hostname
+
+
+class Hypervisors(object):
+    """Stands in for novaclient's hypervisors manager."""
+    def __init__(self, hostnames, paged=True):
+        self.all = [Hypervisor(i + 1, h) for i, h in enumerate(hostnames)]
+        self.paged = paged
+        self.calls = []
+
+    def list(self, detailed=True, marker=None, limit=None):
+        if not self.paged and (marker is not None or limit is not None):
+            raise TypeError("list() got an unexpected keyword argument")
+        self.calls.append((marker, limit))
+        if limit is None:
+            return list(self.all)
+        start = 0
+        if marker is not None:
+            start = [h.id for h in self.all].index(marker) + 1
+        return self.all[start:start + limit]
+
+
+class Nova(object):
+    def __init__(self, hostnames, paged=True):
+        self.hypervisors = Hypervisors(hostnames, paged)
+
+
+class HypervisorHostnamesTest(unittest.TestCase):
+    def test_pages(self):
+        hostnames = ['node%d' % i for i in range(7)]
+        client = Nova(hostnames)
+        self.assertEqual(list(nova.hypervisor_hostnames(client, page_size=3)),
+                         hostnames)
+        self.assertEqual(client.hypervisors.calls,
+                         [(None, 3), (3, 3), (6, 3)])
+
+    def test_full_last_page(self):
+        client = Nova(['a', 'b', 'c', 'd'])
+        self.assertEqual(list(nova.hypervisor_hostnames(client, page_size=2)),
+                         ['a', 'b', 'c', 'd'])
+        # One more request to learn the list has ended
+        self.assertEqual(len(client.hypervisors.calls), 3)
+
+    def test_client_without_paging(self):
+        client = Nova(['a', 'b', 'c'], paged=False)
+        self.assertEqual(list(nova.hypervisor_hostnames(client, page_size=2)),
+                         ['a', 'b', 'c'])
+        self.assertEqual(client.hypervisors.calls, [(None, None)])
+
+
+class SyncMachinesTest(unittest.TestCase):
+    def setUp(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        models.Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+
+    def tearDown(self):
+        self.session.close()
+
+    def add_machine(self, hostname):
+        machine = models.Machine(hostname=hostname)
+        self.session.add(machine)
+        self.session.commit()
+        return machine
+
+    def hostnames(self):
+        return sorted(h for (h,) in
+                      self.session.query(models.Machine.hostname))
+
+    def sync(self, hostnames, **kwargs):
+        client = Nova(hostnames)
+        counts = bulk.sync_machines(
+            self.session, list(nova.hypervisor_hostnames(client, page_size=2)),
+            **kwargs)
+        self.session.commit()
+        return counts
+
+    def test_inserts_new_hosts(self):
+        self.add_machine('node1')
+        self.assertEqual(self.sync(['node1', 'node2', 'node3']), (2, 0, 0))
+        self.assertEqual(self.hostnames(), ['node1', 'node2', 'node3'])
+
+    def test_keeps_short_names(self):
+        self.add_machine('node1')
+        self.add_machine('NODE2')
+        counts = self.sync(['node1.example.com', 'node2.example.com'])
+        self.assertEqual(counts, (0, 0, 0))
+        self.assertEqual(self.hostnames(), ['NODE2', 'node1'])
+
+    def test_rename(self):
+        self.add_machine('node1')
+        self.add_machine('node2.example.com')
+        counts = self.sync(['node1.example.com', 'node2.example.com'],
+                           rename=True)
+        self.assertEqual(counts, (0, 1, 0))
+        self.assertEqual(self.hostnames(),
+                         ['node1.example.com', 'node2.example.com'])
+
+    def test_prune_keeps_machines_with_tickets(self):
+        self.add_machine('node1')
+        busy = self.add_machine('node2')
+        self.add_machine('node3')
+        part = models.Part(description='disk')
+        self.session.add(models.PartRequest(machine=busy, part=part))
+        self.session.commit()
+        self.assertEqual(self.sync(['node1'], prune=True), (0, 0, 1))
+        self.assertEqual(self.hostnames(), ['node1', 'node2'])
+
+    def test_without_prune_keeps_everything(self):
+        self.add_machine('node1')
+        self.add_machine('node2')
+        self.assertEqual(self.sync(['node1']), (0, 0, 0))
+        self.assertEqual(self.hostnames(), ['node1', 'node2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
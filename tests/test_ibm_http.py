@@ -0,0 +1,264 @@
+""" Tests for the browserless ESC driver against a stand-in ESC site. """
+import Cookie
+import itertools
+import threading
+import unittest
+import urlparse
+
+from owen.driver import esc
+from owen.driver.ibm_http import ElectronicServiceRequestHTTP
+from tests.stub_server import StubServer
+
+PREFIX = '/support/esc/'
+
+SIGNIN = """<html><body><form method="post" action="j_security_check">
+<input type="text" name="j_username" id="j_username">
+<input type="password" name="j_password" id="j_password">
+<input type="submit" name="ibm-submit" value="Sign in">
+</form></body></html>"""
+
+PLACECALL_FIELDS = ["Customer_Name", "CustPhoneNumber", "Street", "City",
+                    "Zip", "Contact_Location", "ContactName",
+                    "ContPhoneNumber", "Product", "Model", "Serial_Number",
+                    "Part_Number"]
+
+PLACECALL = """<html><body><form method="post" action="placecall_submit.jsp">
+%s
+<select name="State" id="State"><option value="">--</option>
+<option value="Illinois">Illinois</option></select>
+<textarea name="Comments" id="Comments"></textarea>
+<input type="hidden" name="formid" value="upr">
+<input type="submit" name="ibm-submit" value="Submit">
+</form></body></html>""" % '\n'.join(
+    '<input type="text" name="%s" id="%s">' % (f, f) for f in PLACECALL_FIELDS)
+
+AFTER_HOURS = """<html><body><form method="post" action="afterhours.jsp">
+<input type="radio" name="Status_Type" id="Status_TypeA" value="A">
+<input type="radio" name="Status_Type" id="Status_TypeB" value="B">
+<input type="submit" name="ibm-submit" value="Continue">
+</form></body></html>"""
+
+COMMENT_FORM = """<html><body><form method="post" action="%s">
+<input type="hidden" name="uniqcallid" value="%s">
+<textarea name="Comments" id="Comments"></textarea>
+<input type="submit" name="ibm-submit" value="Submit">
+</form></body></html>"""
+
+
+def page(body, status=200, headers=None):
+    headers = dict(headers or {})
+    headers['Content-Type'] = 'text/html; charset=utf-8'
+    return (status, headers, body)
+
+
+def redirect(target, headers=None):
+    headers = dict(headers or {})
+    headers['Location'] = PREFIX + target
+    return (302, headers, '')
+
+
+class ESC(object):
+    """Just enough of ESC to sign in, list, place and update calls."""
+    def __init__(self, username='user', password='secret'):
+        self.username = username
+        self.password = password
+        self.sessions = set()
+        self.calls = [('C1', 'P0001', 'Open'), ('C2', 'P0002', 'Closed')]
+        self.after_hours = False
+        self.posts = []
+        self.signins = 0
+        self._lock = threading.Lock()
+        self._tokens = itertools.count(1)
+
+    def __call__(self, request):
+        url = urlparse.urlparse(request.path)
+        name = url.path[len(PREFIX):]
+        query = dict(urlparse.parse_qsl(url.query))
+        form = dict(urlparse.parse_qsl(request.body))
+        with self._lock:
+            if request.method == 'POST':
+                self.posts.append((name, form))
+            if name == 'signin.jsp':
+                return page(SIGNIN)
+            if name == 'j_security_check':
+                return self._check_login(form)
+            if not self._signed_in(request):
+                return redirect('signin.jsp')
+            handler = getattr(self, '_' + name.split('.')[0], None)
+            if handler is None:
+                return page('Not found', status=404)
+            return handler(query, form)
+
+    def _signed_in(self, request):
+        cookie = Cookie.SimpleCookie(request.headers.get('Cookie', ''))
+        return ('JSESSIONID' in cookie and
+                cookie['JSESSIONID'].value in self.sessions)
+
+    def _check_login(self, form):
+        if (form.get('j_username') != self.username or
+                form.get('j_password') != self.password):
+            return page(SIGNIN)
+        self.signins += 1
+        token = 'token%d' % next(self._tokens)
+        self.sessions.add(token)
+        return redirect('viewcalls.wss?view=selfreg',
+                        {'Set-Cookie': 'JSESSIONID=%s; Path=/' % token})
+
+    def _viewcalls(self, query, form):
+        rows = ''.join(
+            '<tr><td><a name="count" href="viewcalldetailtext.wss?'
+            'callid=%s">%s</a></td><td>%s</td><td>%s</td></tr>' % (
+                id, id, number, status)
+            for id, number, status in self.calls)
+        return page('<html><body><table><tr><th>Call</th>'
+                    '<th>IBM problem number</th><th>Status</th></tr>%s'
+                    '</table></body></html>' % rows)
+
+    def _viewcalldetailtext(self, query, form):
+        for id, number, status in self.calls:
+            if id == query.get('callid'):
+                return page('<html><body><p>Problem number: %s</p>'
+                            '<p>Status: %s</p></body></html>' % (
+                                number, status))
+        return page('No such call', status=500)
+
+    def _placecall_upr(self, query, form):
+        return page(PLACECALL)
+
+    def _placecall_submit(self, query, form):
+        if self.after_hours:
+            return page(AFTER_HOURS)
+        return self._confirm()
+
+    def _afterhours(self, query, form):
+        return self._confirm()
+
+    def _confirm(self):
+        number = 'P%04d' % (len(self.calls) + 1)
+        self.calls.append(('C%d' % (len(self.calls) + 1), number, 'Open'))
+        return page('<html><body>Your call was placed. Your problem '
+                    'number is <b>%s</b></body></html>' % number)
+
+    def _statusupdate(self, query, form):
+        return page(COMMENT_FORM % ('statusupdate_submit.jsp',
+                                    query['uniqcallid']))
+
+    def _additionalcomments(self, query, form):
+        return page(COMMENT_FORM % ('additionalcomments_submit.jsp',
+                                    query['uniqcallid']))
+
+    def _statusupdate_submit(self, query, form):
+        return page('<html><body>Updated</body></html>')
+
+    _additionalcomments_submit = _statusupdate_submit
+
+
+class ElectronicServiceRequestHTTPTest(unittest.TestCase):
+    def setUp(self):
+        self.esc = ESC()
+        self.server = StubServer(self.esc).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+
+    def driver(self, password='secret'):
+        return ElectronicServiceRequestHTTP(
+            'user', password, base_url=self.server.url + PREFIX[1:])
+
+    def test_sign_in(self):
+        self.driver()
+        self.assertEqual(self.esc.signins, 1)
+        self.assertEqual(self.esc.posts,
+                         [('j_security_check',
+                           {'j_username': 'user', 'j_password': 'secret',
+                            'ibm-submit': 'Sign in'})])
+
+    def test_bad_password(self):
+        self.assertRaises(esc.ESCError, self.driver, 'wrong')
+
+    def test_signs_in_again_when_session_expires(self):
+        driver = self.driver()
+        self.esc.sessions.clear()
+        self.assertEqual(len(driver.list_requests()), 2)
+        self.assertEqual(self.esc.signins, 2)
+
+    def test_listing(self):
+        driver = self.driver()
+        tickets = driver.list_requests()
+        self.assertEqual([(t.id, t.case_number()) for t in tickets],
+                         [('C1', 'P0001'), ('C2', 'P0002')])
+        self.assertEqual(driver.get_request_by_number('P0002').id, 'C2')
+        self.assertEqual(driver.get_request('C1').case_number(), 'P0001')
+        self.assertEqual(driver.get_request('C9'), None)
+
+    def test_details(self):
+        details = self.driver().get_request('C2').details()
+        self.assertEqual(esc.find_status(details), 'Closed')
+
+    def test_fetch_details_concurrently(self):
+        self.esc.calls.extend(('C%d' % i, 'P%04d' % i, 'Open')
+                              for i in range(3, 11))
+        results = list(self.driver().fetch_details(
+            ['C%d' % i for i in range(1, 11)] + ['C99'], concurrency=4))
+        failed = [r.call_id for r in results if r.error is not None]
+        self.assertEqual(failed, ['C99'])
+        statuses = dict((r.call_id, esc.find_status(r.details))
+                        for r in results if r.error is None)
+        self.assertEqual(len(statuses), 10)
+        self.assertEqual(statuses['C2'], 'Closed')
+
+    def test_concurrent_fetches_sign_in_once(self):
+        self.esc.calls.extend(('C%d' % i, 'P%04d' % i, 'Open')
+                              for i in range(3, 21))
+        driver = self.driver()
+        self.esc.sessions.clear()
+        results = list(driver.fetch_details(
+            ['C%d' % i for i in range(1, 21)], concurrency=4))
+        self.assertEqual([r.error for r in results], [None] * 20)
+        self.assertEqual(self.esc.signins, 2)
+
+    def test_create_request(self):
+        driver = self.driver()
+        self.assertEqual(len(driver.list_requests()), 2)
+        number = driver.create_request(product='7915AC1', serial='S1',
+                                       part='FRU1', comments='Disk failed')
+        self.assertEqual(number, 'P0003')
+        name, form = self.esc.posts[-1]
+        self.assertEqual(name, 'placecall_submit.jsp')
+        self.assertEqual(form['Product'], '7915')
+        self.assertEqual(form['Model'], 'AC1')
+        self.assertEqual(form['Serial_Number'], 'S1')
+        self.assertEqual(form['Part_Number'], 'FRU1')
+        self.assertEqual(form['State'], 'Illinois')
+        self.assertEqual(form['Comments'], 'Disk failed')
+        self.assertEqual(form['formid'], 'upr')
+        # The cached listing was dropped and shows the new call
+        self.assertEqual(driver.get_request_by_number('P0003').id, 'C3')
+
+    def test_create_request_after_hours(self):
+        self.esc.after_hours = True
+        number = self.driver().create_request(product='7915', serial='S1')
+        self.assertEqual(number, 'P0003')
+        name, form = self.esc.posts[-1]
+        self.assertEqual(name, 'afterhours.jsp')
+        self.assertEqual(form['Status_Type'], 'A')
+
+    def test_add_info(self):
+        ticket = self.driver().get_request('C1')
+        self.assertTrue(ticket.add_info('x' * 200))
+        name, form = self.esc.posts[-1]
+        self.assertEqual(name, 'additionalcomments_submit.jsp')
+        self.assertEqual(form['uniqcallid'], 'C1')
+        self.assertEqual(form['Comments'], 'x' * 149)
+
+    def test_cancel_request(self):
+        ticket = self.driver().get_request('C1')
+        self.assertTrue(ticket.cancel_request('Not needed'))
+        query = urlparse.urlparse(self.server.requests[-2].path).query
+        self.assertEqual(urlparse.parse_qs(query)['actionflag'], ['CA'])
+        name, form = self.esc.posts[-1]
+        self.assertEqual(name, 'statusupdate_submit.jsp')
+        self.assertEqual(form, {'uniqcallid': 'C1', 'Comments': 'Not needed',
+                                'ibm-submit': 'Submit'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+""" Tests for the background submission queue. """
+import unittest
+
+from owen import jobs
+
+
+class JobQueueTest(unittest.TestCase):
+    def test_runs_jobs(self):
+        queue = jobs.JobQueue(workers=2)
+        ok = queue.submit(lambda: {'problem_number': 'P1'})
+        failed = queue.submit(lambda: 1 / 0)
+        self.assertTrue(queue.join(5))
+        self.assertEqual(queue.get(ok.id).to_dict()['problem_number'], 'P1')
+        self.assertEqual(failed.status, jobs.FAILED)
+        self.assertIn('division', failed.error)
+
+    def test_repeated_key_returns_same_job(self):
+        queue = jobs.JobQueue(workers=1)
+        first = queue.submit_keyed('k', lambda: {})
+        self.assertTrue(first is queue.submit_keyed('k', lambda: {}))
+        self.assertTrue(queue.join(5))
+        self.assertTrue(first is queue.submit_keyed('k', lambda: {}))
+        self.assertFalse(first is queue.submit_keyed('other', lambda: {}))
+
+    def test_failed_job_key_is_released(self):
+        queue = jobs.JobQueue(workers=1)
+        first = queue.submit_keyed('k', lambda: 1 / 0)
+        self.assertTrue(queue.join(5))
+        second = queue.submit_keyed('k', lambda: {})
+        self.assertFalse(first is second)
+
+    def test_finished_jobs_expire(self):
+        queue = jobs.JobQueue(workers=1, retention=0, dedupe_window=0)
+        job = queue.submit_keyed('k', lambda: {})
+        self.assertTrue(queue.join(5))
+        job.finished -= 1
+        self.assertFalse(queue.submit_keyed('k', lambda: {}) is job)
+        self.assertEqual(queue.get(job.id), None)
+
+    def test_keyed_job_outlives_retention(self):
+        # A key that still dedupes must not hand out a job that 404s
+        queue = jobs.JobQueue(workers=1, retention=0, dedupe_window=3600)
+        job = queue.submit_keyed('k', lambda: {})
+        queue.submit(lambda: {})
+        self.assertTrue(queue.join(5))
+        job.finished -= 1
+        self.assertTrue(queue.submit_keyed('k', lambda: {}) is job)
+        self.assertTrue(queue.get(job.id) is job)
+
+
+if __name__ == '__main__':
+    unittest.main()
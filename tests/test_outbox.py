@@ -0,0 +1,152 @@
+""" Tests for the submission outbox against a stand-in submitter. """
+import unittest
+
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+
+from owen import outbox
+from owen.cmd.ibm_ticket import SubmitResult
+from owen.db import models
+
+
+class Submitter(object):
+    """Accepts submissions unless they hold a ticket in `refused`, and
+    answers job lookups from `jobs`."""
+    def __init__(self):
+        self.jobs = {}
+        self.sent = []
+        self.keys = []
+        self.refused = set()
+
+    def _accept(self, part_requests):
+        self.sent.append([pr.id for pr in part_requests])
+        if self.refused.intersection(pr.id for pr in part_requests):
+            return SubmitResult(list(part_requests), False, 400, None,
+                                'Failed ticket submit request! 400')
+        job = {'id': 'job%d' % len(self.sent), 'status': 'queued'}
+        return SubmitResult(list(part_requests), True, 202, job, None)
+
+    def submit_tickets(self, part_requests, keys):
+        self.keys.append(keys)
+        return self._accept(part_requests)
+
+    def submit_each(self, part_requests, keys):
+        self.keys.append(keys)
+        return [self._accept([pr]) for pr in part_requests]
+
+    def job_status(self, job_id, part_requests):
+        if job_id not in self.jobs:
+            return SubmitResult(part_requests, False, 404, None, 'gone')
+        return SubmitResult(part_requests, True, 200, self.jobs[job_id], None)
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        models.Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        part = models.Part(description='disk', fru='1')
+        self.tickets = [
+            models.PartRequest(part=part, machine=models.Machine(
+                hostname='h%d' % i, machine_type='7x', serial='S%d' % i))
+            for i in range(3)]
+        outbox.enqueue(self.session, self.tickets)
+        self.session.commit()
+        self.submitter = Submitter()
+
+    def tearDown(self):
+        self.session.close()
+
+    def entries(self):
+        return self.session.query(models.OutboxEntry).\
+            order_by(models.OutboxEntry.id).all()
+
+    def test_resends_only_calls_that_never_reached_esc(self):
+        outbox.flush(self.session, self.submitter)
+        self.submitter.jobs['job1'] = {
+            'id': 'job1', 'status': 'succeeded', 'results': [
+                {'status': 'succeeded', 'problem_number': 'P1',
+                 'submitted': True},
+                {'status': 'failed', 'error': 'login', 'submitted': False},
+                {'status': 'failed', 'error': 'no confirmation',
+                 'submitted': True}]}
+        sent, delivered, failed, held = outbox.flush(self.session,
+                                                     self.submitter)
+        self.assertEqual((sent, delivered, failed), (1, 1, 1))
+        first, second, third = self.entries()
+        self.assertTrue(first.delivered)
+        self.assertEqual(self.tickets[0].ticket_number, 'P1')
+        self.assertEqual(second.job_id, 'job2')
+        self.assertEqual(held, [third])
+        self.assertTrue(third.held)
+        self.assertEqual(third.last_error, 'no confirmation')
+        self.assertEqual(self.submitter.sent, [[1, 2, 3], [2]])
+        # A resend goes with the entry's own key
+        self.assertEqual(self.submitter.keys[1],
+                         [second.idempotency_key])
+        self.assertEqual(len(set(self.submitter.keys[0])), 3)
+
+    def test_holds_failed_jobs_unless_never_submitted(self):
+        outbox.flush(self.session, self.submitter, each=True)
+        self.submitter.jobs['job1'] = {'id': 'job1', 'status': 'failed',
+                                       'error': 'login', 'submitted': False}
+        self.submitter.jobs['job2'] = {'id': 'job2', 'status': 'failed',
+                                       'error': 'worker died'}
+        # job3 is unknown to the server
+        sent, delivered, failed, held = outbox.flush(self.session,
+                                                     self.submitter)
+        self.assertEqual((sent, delivered, failed), (1, 0, 1))
+        self.assertEqual([e.part_request_id for e in held], [2, 3])
+        self.assertEqual(self.submitter.sent[-1], [1])
+
+    def test_refused_batch_is_sent_per_ticket(self):
+        self.submitter.refused.add(2)
+        sent, delivered, failed, held = outbox.flush(self.session,
+                                                     self.submitter)
+        self.assertEqual((sent, failed, held), (2, 1, []))
+        self.assertEqual(self.submitter.sent, [[1, 2, 3], [1], [2], [3]])
+        self.assertEqual([e.job_id for e in self.entries()],
+                         ['job2', None, 'job4'])
+
+    def test_holds_after_max_attempts(self):
+        self.submitter.refused.add(2)
+        for i in range(2):
+            outbox.flush(self.session, self.submitter, max_attempts=3)
+        sent, delivered, failed, held = outbox.flush(
+            self.session, self.submitter, max_attempts=3)
+        second = self.entries()[1]
+        self.assertEqual(held, [second])
+        self.assertEqual(second.attempts, 3)
+        self.assertIn('gave up after 3 attempts', second.last_error)
+        outbox.flush(self.session, self.submitter, max_attempts=3)
+        self.assertEqual(self.submitter.sent[-1], [2])
+        self.assertEqual(len(self.submitter.sent), 6)
+
+    def test_enqueue_leaves_out_incomplete_machines(self):
+        pr = models.PartRequest(part=self.tickets[0].part,
+                                machine=models.Machine(hostname='bare'))
+        self.assertEqual(outbox.enqueue(self.session, [pr]), [pr])
+        self.assertEqual(outbox.unsendable(pr.machine),
+                         'machine bare has no machine type')
+        self.session.commit()
+        self.assertEqual(len(self.entries()), 3)
+
+    def test_requeue_and_settle(self):
+        outbox.flush(self.session, self.submitter, each=True)
+        outbox.flush(self.session, self.submitter)
+        self.assertEqual(len(self.entries()), 3)
+        self.assertTrue(all(e.held for e in self.entries()))
+        self.assertEqual(outbox.requeue(self.session, [1]), 1)
+        self.assertEqual(outbox.settle(self.session, [2]), 1)
+        self.session.commit()
+        self.session.expire_all()
+        first, second, third = self.entries()
+        self.assertEqual((first.held, first.job_id), (False, None))
+        self.assertEqual((second.held, second.delivered), (False, True))
+        self.assertTrue(third.held)
+        outbox.flush(self.session, self.submitter)
+        self.assertEqual(self.submitter.sent[-1], [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
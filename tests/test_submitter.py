@@ -0,0 +1,190 @@
+""" Tests for TicketSubmitter against a stand-in submission server. """
+import ConfigParser
+import hashlib
+import json
+import StringIO
+import unittest
+
+from owen.cmd.ibm_ticket import TicketSubmitter
+from tests.stub_server import StubServer
+
+SETTINGS = ['secret', 'j_username', 'j_password', 'Customer_Name',
+            'CustPhoneNumber', 'Street', 'City', 'State', 'Zip',
+            'Contact_Location', 'ContactName', 'ContPhoneNumber']
+
+
+class Record(object):
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def part_request(id, serial='S1', fru='FRU1'):
+    return Record(id=id, part=Record(fru=fru, description='disk'),
+                  machine=Record(machine_type='7x', serial=serial))
+
+
+def json_reply(status, body):
+    return (status, {'Content-Type': 'application/json'}, json.dumps(body))
+
+
+class Replies(object):
+    """Answers requests with the given replies in turn, then 202s."""
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.count = 0
+
+    def __call__(self, request):
+        self.count += 1
+        if self.replies:
+            return self.replies.pop(0)
+        return json_reply(202, {'id': 'job%d' % self.count,
+                                'status': 'queued'})
+
+
+class TicketSubmitterTest(unittest.TestCase):
+    def submitter(self, url, retries=3):
+        lines = ['[default]', 'submit_url = ' + url,
+                 'submit_retries = %d' % retries, 'submit_backoff = 0.01',
+                 'submit_timeout = 5']
+        lines.extend('%s = %s' % (s, s.lower()) for s in SETTINGS)
+        config = ConfigParser.ConfigParser()
+        config.readfp(StringIO.StringIO('\n'.join(lines)))
+        return TicketSubmitter(config)
+
+    def test_accepted(self):
+        with StubServer(Replies()) as server:
+            pr = part_request(7)
+            result = self.submitter(server.url).submit_ticket(pr, key='k7')
+        self.assertTrue(result.ok)
+        self.assertEqual(result.status_code, 202)
+        self.assertEqual(result.job['id'], 'job1')
+        self.assertEqual(result.part_requests, [pr])
+        self.assertEqual(result.error, None)
+        request = server.requests[0]
+        self.assertEqual(request.path, '/')
+        self.assertEqual(request.headers['Idempotency-Key'], 'k7')
+        body = json.loads(request.body)
+        self.assertEqual(body['Serial_Number'], 'S1')
+        self.assertEqual(body['Part_Number'], 'FRU1')
+        self.assertEqual(body['secret'], 'secret')
+
+    def test_retries_transient_failures(self):
+        replies = Replies((503, {}, ''), (429, {}, ''), (502, {}, ''))
+        with StubServer(replies) as server:
+            result = self.submitter(server.url).submit_ticket(
+                part_request(1), key='k1')
+        self.assertTrue(result.ok)
+        self.assertEqual(len(server.requests), 4)
+        # Every attempt carries the same key so the server can dedupe
+        self.assertEqual(set(r.headers['Idempotency-Key']
+                             for r in server.requests), set(['k1']))
+
+    def test_no_key_without_one_given(self):
+        with StubServer(Replies()) as server:
+            self.submitter(server.url).submit_ticket(part_request(1))
+        # The server derives one from the ticket instead
+        self.assertNotIn('Idempotency-Key', server.requests[0].headers)
+
+    def test_gives_up_after_retries(self):
+        with StubServer(lambda request: (500, {}, '')) as server:
+            result = self.submitter(server.url, retries=2).submit_ticket(
+                part_request(1))
+        self.assertFalse(result.ok)
+        self.assertEqual(result.status_code, 500)
+        self.assertEqual(result.job, None)
+        self.assertIn('500', result.error)
+        self.assertEqual(len(server.requests), 3)
+
+    def test_does_not_retry_client_errors(self):
+        for status in (400, 403):
+            with StubServer(lambda request: (status, {}, '')) as server:
+                result = self.submitter(server.url).submit_ticket(
+                    part_request(1))
+            self.assertFalse(result.ok)
+            self.assertEqual(result.status_code, status)
+            self.assertEqual(len(server.requests), 1)
+
+    def test_connection_refused(self):
+        # Take a free port and close it again
+        with StubServer(Replies()) as server:
+            url = server.url
+        result = self.submitter(url, retries=1).submit_ticket(
+            part_request(1))
+        self.assertFalse(result.ok)
+        self.assertEqual(result.status_code, None)
+        self.assertIn('Failed ticket submit request', result.error)
+
+    def test_reply_without_job(self):
+        for reply in [(200, {'Content-Type': 'text/plain'}, ''),
+                      json_reply(202, ['not', 'a', 'job'])]:
+            with StubServer(lambda request: reply) as server:
+                result = self.submitter(server.url).submit_ticket(
+                    part_request(1))
+            self.assertFalse(result.ok)
+            self.assertEqual(result.status_code, reply[0])
+            self.assertEqual(result.job, None)
+            self.assertIn('Failed ticket submit request', result.error)
+            self.assertEqual(len(server.requests), 1)
+
+    def test_bad_url(self):
+        submitter = self.submitter('ftp://127.0.0.1/')
+        results = submitter.submit_each([part_request(1), part_request(2)])
+        self.assertEqual([r.ok for r in results], [False, False])
+        self.assertIn('Failed ticket submit request', results[0].error)
+
+    def test_submit_each_keeps_order(self):
+        def reply(request):
+            serial = json.loads(request.body)['Serial_Number']
+            if serial == 'bad':
+                return (400, {}, '')
+            return json_reply(202, {'id': 'job-' + serial})
+        prs = [part_request(i, serial=s)
+               for i, s in enumerate(['a', 'bad', 'c', 'd', 'e'])]
+        keys = ['k%d' % pr.id for pr in prs]
+        with StubServer(reply) as server:
+            results = self.submitter(server.url).submit_each(prs, keys)
+        self.assertEqual([r.part_requests for r in results],
+                         [[pr] for pr in prs])
+        self.assertEqual([r.ok for r in results],
+                         [True, False, True, True, True])
+        self.assertEqual(results[3].job['id'], 'job-d')
+        self.assertEqual(sorted((json.loads(r.body)['Serial_Number'],
+                                 r.headers['Idempotency-Key'])
+                                for r in server.requests),
+                         [('a', 'k0'), ('bad', 'k1'), ('c', 'k2'),
+                          ('d', 'k3'), ('e', 'k4')])
+
+    def test_submit_tickets_sends_one_batch(self):
+        prs = [part_request(1, serial='a'), part_request(2, serial='b')]
+        with StubServer(Replies((503, {}, ''))) as server:
+            result = self.submitter(server.url).submit_tickets(
+                prs, ['k1', 'k2'])
+        self.assertTrue(result.ok)
+        self.assertEqual(result.part_requests, prs)
+        self.assertEqual([r.path for r in server.requests],
+                         ['/batch', '/batch'])
+        self.assertEqual(server.requests[0].headers['Idempotency-Key'],
+                         hashlib.sha1('k1,k2').hexdigest())
+        body = json.loads(server.requests[0].body)
+        self.assertEqual([t['Serial_Number'] for t in body['tickets']],
+                         ['a', 'b'])
+
+    def test_job_status(self):
+        def reply(request):
+            if request.path == '/jobs/abc':
+                return json_reply(200, {'id': 'abc', 'status': 'succeeded',
+                                        'problem_number': 'P1'})
+            return (404, {}, '')
+        with StubServer(reply) as server:
+            submitter = self.submitter(server.url)
+            found = submitter.job_status('abc', [part_request(1)])
+            missing = submitter.job_status('xyz', [part_request(1)])
+        self.assertTrue(found.ok)
+        self.assertEqual(found.job['problem_number'], 'P1')
+        self.assertFalse(missing.ok)
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual([r.method for r in server.requests], ['GET', 'GET'])
+
+
+if __name__ == '__main__':
+    unittest.main()